@@ -1,16 +1,80 @@
 import datetime
 import logging
+import math
+from collections import namedtuple, OrderedDict
+from contextlib import ExitStack
 
+import requests
 import telegram
 import tweepy
-from pytz import timezone, utc
 from telegram import Bot
-from telegram.error import TelegramError
+from telegram.error import TelegramError, NetworkError, RetryAfter, BadRequest
 from telegram.utils.request import Request
 from dateutil.parser import parse
 
-from models import TelegramChat, TwitterUser
-from util import escape_markdown, prepare_tweet_text
+import config
+from credentials import CredentialPool
+from media import MediaCache
+from models import TelegramChat, TwitterUser, TweetMedia, write_transaction
+from ratelimit import TelegramRateLimiter
+from util import escape_markdown, prepare_tweet_text, get_timezone, LRUCache, lookup_users
+
+# rendered messages kept, one per (tweet, timezone)
+RENDER_CACHE_SIZE = 10000
+
+# Telegram file_ids of sent media, by media url, so a tweet's media are only
+# fetched from Twitter by Telegram once however many chats get it
+FILE_ID_CACHE_SIZE = 10000
+FILE_ID_TTL = 24 * 60 * 60
+
+# media Telegram can't fetch by url are downloaded and uploaded instead
+MEDIA_CACHE_DIR = 'media_cache'
+MEDIA_CACHE_SIZE = 1024 * 1024 * 1024
+UPLOAD_TIMEOUT = 120
+
+# screen names per users/lookup call, the most it takes
+LOOKUP_CHUNK = 100
+
+# screen name -> TwitterUser, so popular accounts aren't looked up for every /sub
+TW_USER_CACHE_SIZE = 10000
+TW_USER_TTL = 60 * 60
+
+# longest a tweet delivery waits for the rate limiter before it is rescheduled
+SEND_MAX_WAIT = 5
+
+# what Telegram answers when it can't fetch a media url itself, worth an upload
+MEDIA_FETCH_ERRORS = ('failed to get http url content',
+                      'wrong file identifier/http url specified',
+                      'wrong type of the web page content')
+
+# what Telegram answers for a file_id it doesn't know (anymore)
+FILE_ID_ERROR = 'wrong file identifier'
+
+# returned by send_tweet when a delivery has to be tried again later. delay is
+# None for failures, which back off, and the flood wait otherwise
+Retry = namedtuple('Retry', 'delay text_sent')
+
+
+def is_transient(error):
+    # BadRequest derives from NetworkError but retrying it won't help
+    return isinstance(error, NetworkError) and not isinstance(error, BadRequest)
+
+
+def is_media_fetch_error(error):
+    if not isinstance(error, BadRequest):
+        return False
+    return any(m in error.message.lower() for m in MEDIA_FETCH_ERRORS)
+
+
+def file_id_of(message):
+    """The file_id of the photo or video a sent message carries"""
+    if message.photo:
+        # the same photo in several sizes, the largest comes last
+        return message.photo[-1].file_id
+    for attachment in (message.video, message.animation, message.document):
+        if attachment is not None:
+            return attachment.file_id
+    return None
 
 
 class TwitterForwarderBot(Bot):
@@ -20,106 +84,100 @@ class TwitterForwarderBot(Bot):
         self.logger.info("Initializing")
         self.update_offset = update_offset
         self.tw = tweepy_api_object
+        self.credentials = CredentialPool(tweepy_api_object)
         self._request = Request(con_pool_size=8)
+        self.limiter = TelegramRateLimiter()
+        self.rendered = LRUCache(RENDER_CACHE_SIZE)
+        self.file_ids = LRUCache(FILE_ID_CACHE_SIZE, ttl=FILE_ID_TTL)
+        self.tw_users = LRUCache(TW_USER_CACHE_SIZE, ttl=TW_USER_TTL)
+        self.media_cache = MediaCache(config.get('MEDIA_CACHE_DIR', MEDIA_CACHE_DIR),
+                                      config.get('MEDIA_CACHE_SIZE', MEDIA_CACHE_SIZE))
+        # the ShardCoordinator of a fetch worker process, None fetches everything
+        self.shards = None
+
+    def _throttled(self, method, chat_id, max_wait, *args, **kwargs):
+        # a media group counts as one message per item
+        wait = self.limiter.acquire(chat_id, max_wait, len(kwargs.get('media') or ()) or 1)
+        if wait:
+            raise RetryAfter(math.ceil(wait))
+        try:
+            return method(chat_id, *args, **kwargs)
+        except RetryAfter as e:
+            self.limiter.retry_after(chat_id, e.retry_after)
+            raise
+
+    def send_message(self, chat_id, *args, **kwargs):
+        return self._throttled(super().send_message, chat_id, None, *args, **kwargs)
+
+    def send_media_group(self, chat_id, media, **kwargs):
+        return self._throttled(super().send_media_group, chat_id, None, media=media, **kwargs)
+
+    sendMessage = send_message
+    sendMediaGroup = send_media_group
 
     def reply(self, update, text, *args, **kwargs):
         self.sendMessage(chat_id=update.message.chat.id, text=text, *args, **kwargs)
 
-    def send_tweet(self, chat, tweet, sub_kind):
+    def send_tweet(self, chat, tweet, sub_kind, media=None, text_sent=False):
+        """
+        Send a tweet to a chat.
+
+        media are the tweet's TweetMedia rows, loaded when not given. Returns
+        None when the tweet was sent, filtered out or can't ever be delivered,
+        and a Retry when it should be tried again later. With text_sent only
+        the tweet's media are sent.
+        """
+        if media is None:
+            media = list(tweet.media.order_by(TweetMedia.kind, TweetMedia.position))
+        photos = [m for m in media if m.kind == 'photo']
+        videos = [m for m in media if m.kind == 'video']
+
         try:
             if sub_kind == 1:
                 if tweet.text[0:1] == 'RT':
-                    return
+                    return None
             elif sub_kind == 2:
                 if tweet.text[0] == '@':
-                    return
+                    return None
             elif sub_kind == 3:
-                if len(eval(tweet.photo_url)) == 0:
-                    return
+                if not photos:
+                    return None
 
             self.logger.debug("Sending tweet {} to chat {}...".format(
                 tweet.tw_id, chat.chat_id
             ))
 
-            '''
-            Use a soft-hyphen to put an invisible link to the first
-            image in the tweet, which will then be displayed as preview
-            '''
-            photo_url = ''
-            video_url = ''
-
-            if len(eval(tweet.photo_url)) != 0:
-                photo_url = '[\xad](%s)' % eval(tweet.photo_url)[0]
-            if tweet.video_url:
-                video_url = tweet.video_url
-
-            created_dt = parse(tweet.created_at)
-            #created_dt = datetime.datetime(tweet.created_at)
-            if chat.timezone_name is not None:
-                tz = timezone(chat.timezone_name)
-                created_dt = created_dt.astimezone(tz)
-            created_at = created_dt.strftime('%Y-%m-%d %H:%M:%S %Z')
-            self.sendMessage(
-                chat_id=chat.chat_id,
-                disable_web_page_preview=not photo_url,
-                text="""
-*{name}* ([@{screen_name}](https://twitter.com/{screen_name})) at {created_at}:
-{text}
--- [Link to this Tweet](https://twitter.com/{screen_name}/status/{tw_id})
-"""
-                .format(
-                    text=prepare_tweet_text(tweet.text),
-                    name=escape_markdown(tweet.name),
-                    screen_name=tweet.screen_name,
-                    created_at=created_at,
-                    tw_id=tweet.tw_id,
-                ),
-                parse_mode=telegram.ParseMode.MARKDOWN)
-
-            MediaList = []
-            if video_url:
-                try:
-                    MediaList.append(telegram.InputMediaVideo(media=tweet.video_url))
-                except TelegramError as e:
-                    self.logger.warning("Sending tweet {} video failed, video url is {}, error is {}".format(
-                        tweet.tw_id, tweet.video_url, e
-                    ))
-                    file = open("video_url.txt", "a")
-                    file.write('\n')
-                    file.write(str(video_url))
-                    file.write('\n')
-                    file.write(str(tweet.video_url))
-                    file.close()
-            else:
-                try:
-                    if photo_url:
-                        for img in eval(tweet.photo_url):
-                            MediaList.append(telegram.InputMediaPhoto(media=img))
-                except TelegramError as e:
-                    self.logger.warning("Sending tweet {} img failed, img url is {}, error is {}".format(
-                        tweet.tw_id, tweet.photo_url, e
-                    ))
-                    file = open("photo_url.txt", "a")
-                    file.write('\n')
-                    file.write(str(photo_url))
-                    file.write('\n')
-                    file.write(str(tweet.photo_url))
-                    file.close()
-
-            if len(MediaList) != 0:
+            if not text_sent:
+                self._throttled(
+                    super().send_message,
+                    chat.chat_id,
+                    SEND_MAX_WAIT,
+                    disable_web_page_preview=not photos,
+                    text=self.render_tweet(tweet, chat.timezone_name),
+                    parse_mode=telegram.ParseMode.MARKDOWN)
+                text_sent = True
+
+            # a video comes with its thumbnail as a photo, send only the video
+            items = videos[:1] or photos
+            if items:
                 try:
-                    self.sendMediaGroup(
-                        chat_id=chat.chat_id,
-                        media=MediaList
-                    )
-                except TelegramError as e:
-                    self.logger.warning("Sending tweet {} img failed, img url is {}, error is {}".format(
-                        tweet.tw_id, MediaList, e
-                    ))
-                    file = open("media_url.txt", "a")
-                    file.write('\n')
-                    file.write(str(MediaList))
-                    file.close()
+                    self.send_media(chat.chat_id, items)
+                except BadRequest as e:
+                    # anything else is about the chat, see below
+                    if not is_media_fetch_error(e):
+                        raise
+                    self.logger.info(
+                        "Telegram couldn't fetch the media of tweet {} ({}), uploading them".format(
+                            tweet.tw_id, e
+                        ))
+                    self.upload_media(chat.chat_id, tweet, items)
+
+            return None
+
+        except RetryAfter as e:
+            self.logger.debug("Flood control on chat {}, retrying in {}s".format(
+                chat.chat_id, e.retry_after))
+            return Retry(e.retry_after, text_sent)
 
         except TelegramError as e:
             self.logger.info("Couldn't send tweet {} to chat {}: {}".format(
@@ -138,6 +196,123 @@ class TwitterForwarderBot(Bot):
                 self.logger.info("Marking chat for deletion")
                 chat.delete_soon = True
                 chat.save()
+                return None
+
+            # only network trouble is worth another try
+            if is_transient(e):
+                return Retry(None, text_sent)
+            return None
+
+    def send_media(self, chat_id, items):
+        """
+        Send TweetMedia rows as a media group. Items sent before go by their
+        file_id, and the file_ids of this send are remembered for the next chats.
+        """
+        cached = [m.url for m in items if self.file_ids.get(m.url) is not None]
+        try:
+            messages = self._throttled(
+                super().send_media_group,
+                chat_id,
+                SEND_MAX_WAIT,
+                media=[self.input_media(m) for m in items]
+            )
+        except BadRequest as e:
+            if not cached or FILE_ID_ERROR not in e.message.lower():
+                raise
+            # a file_id Telegram doesn't know anymore, send by url again
+            for url in cached:
+                self.file_ids.pop(url)
+            return self.send_media(chat_id, items)
+
+        self.remember_file_ids(items, messages)
+        return messages
+
+    def upload_media(self, chat_id, tweet, items):
+        """Send TweetMedia rows as files, from the local media cache"""
+        with ExitStack() as files:
+            try:
+                # opened right away, an open file outlives its eviction from the cache
+                handles = [files.enter_context(open(self.media_cache.get(m.url), 'rb'))
+                           for m in items]
+            except (requests.RequestException, OSError) as e:
+                self.media_failed(tweet, items, e)
+                return
+
+            media = []
+            for item, f in zip(items, handles):
+                if item.kind == 'video':
+                    media.append(telegram.InputMediaVideo(media=f))
+                else:
+                    media.append(telegram.InputMediaPhoto(media=f))
+            try:
+                messages = self._throttled(
+                    super().send_media_group,
+                    chat_id,
+                    SEND_MAX_WAIT,
+                    media=media,
+                    timeout=UPLOAD_TIMEOUT
+                )
+            except TelegramError as e:
+                if isinstance(e, RetryAfter) or is_transient(e):
+                    raise
+                self.media_failed(tweet, items, e)
+                return
+        self.logger.debug("Media cache hit rate {:.0%}".format(self.media_cache.hit_rate))
+        self.remember_file_ids(items, messages)
+
+    def remember_file_ids(self, items, messages):
+        for item, message in zip(items, messages or ()):
+            file_id = file_id_of(message)
+            if file_id is not None:
+                self.file_ids.put(item.url, file_id)
+
+    def media_failed(self, tweet, items, error):
+        self.logger.warning("Sending tweet {} media failed, media urls are {}, error is {}".format(
+            tweet.tw_id, [m.url for m in items], error
+        ))
+        file = open("media_url.txt", "a")
+        file.write('\n')
+        file.write(str([m.url for m in items]))
+        file.close()
+
+    def input_media(self, item):
+        media = self.file_ids.get(item.url, item.url)
+        if item.kind == 'video':
+            return telegram.InputMediaVideo(media=media)
+        return telegram.InputMediaPhoto(media=media)
+
+    def render_tweet(self, tweet, timezone_name):
+        """
+        The message text of a tweet in a timezone. Rendering only depends on
+        those two, so it is done once and shared by every subscribed chat.
+        """
+        key = (tweet.tw_id, timezone_name)
+        text = self.rendered.get(key)
+        if text is not None:
+            return text
+
+        created_dt = tweet.created_at
+        if not isinstance(created_dt, datetime.datetime):
+            created_dt = parse(created_dt)
+        if created_dt.tzinfo is None:
+            # stored without its offset, Twitter's timestamps are UTC
+            created_dt = created_dt.replace(tzinfo=datetime.timezone.utc)
+        if timezone_name is not None:
+            created_dt = created_dt.astimezone(get_timezone(timezone_name))
+        created_at = created_dt.strftime('%Y-%m-%d %H:%M:%S %Z')
+        text = """
+*{name}* ([@{screen_name}](https://twitter.com/{screen_name})) at {created_at}:
+{text}
+-- [Link to this Tweet](https://twitter.com/{screen_name}/status/{tw_id})
+""".format(
+            text=prepare_tweet_text(tweet.text),
+            name=escape_markdown(tweet.name),
+            screen_name=tweet.screen_name,
+            created_at=created_at,
+            tw_id=tweet.tw_id,
+        )
+        self.rendered.put(key, text)
+        return text
 
     def get_chat(self, tg_chat):
         db_chat, _created = TelegramChat.get_or_create(
@@ -146,23 +321,53 @@ class TwitterForwarderBot(Bot):
         )
         return db_chat
 
-    def get_tw_user(self, tw_username):
-        try:
-            tw_user = self.tw.get_user(screen_name=tw_username)
-        except tweepy.errors.TweepyException as err:
-            self.logger.error(err)
-            return None
+    def get_tw_users(self, tw_usernames):
+        """
+        Resolve screen names to stored TwitterUsers. Names resolved recently are
+        served from the tw_users cache, the others are looked up on Twitter,
+        LOOKUP_CHUNK per call, and stored.
 
-        db_user, _created = TwitterUser.get_or_create(
-            screen_name=tw_user.screen_name,
-            defaults={
-                'name': tw_user.name,
-            },
-        )
+        Returns {lowercased screen name: TwitterUser} for the names that exist,
+        and the names that couldn't be looked up (rate limit, network trouble).
+        """
+        names = list(OrderedDict.fromkeys(name.lower() for name in tw_usernames))
+
+        # cached rows are re-read in one query, they may have been renamed or removed since
+        cached = {}
+        for name in names:
+            tw_user = self.tw_users.get(name)
+            if tw_user is not None:
+                cached[tw_user.id] = name
+        resolved = {}
+        if cached:
+            for tw_user in TwitterUser.select().where(TwitterUser.id << list(cached)):
+                if tw_user.screen_name.lower() == cached[tw_user.id]:
+                    resolved[cached[tw_user.id]] = tw_user
+        missing = [name for name in names if name not in resolved]
+
+        found = []
+        failed = []
+        for i in range(0, len(missing), LOOKUP_CHUNK):
+            chunk = missing[i:i + LOOKUP_CHUNK]
+            try:
+                found.extend(lookup_users(self.tw, screen_name=chunk))
+            except tweepy.errors.TweepyException as err:
+                # they may well exist, say so instead of "not found"
+                self.logger.error(err)
+                failed.extend(chunk)
+
+        if found:
+            rows = [{'screen_name': u.screen_name, 'name': u.name, 'tw_id': u.id} for u in found]
+            with write_transaction():
+                for i in range(0, len(rows), LOOKUP_CHUNK):
+                    (TwitterUser.insert_many(rows[i:i + LOOKUP_CHUNK])
+                     .on_conflict(conflict_target=[TwitterUser.screen_name],
+                                  preserve=[TwitterUser.name, TwitterUser.tw_id])
+                     .execute())
 
-        if not _created:
-            if db_user.name != tw_user.name:
-                db_user.name = tw_user.name
-                db_user.save()
+            screen_names = [row['screen_name'] for row in rows]
+            for tw_user in TwitterUser.select().where(TwitterUser.screen_name << screen_names):
+                resolved[tw_user.screen_name.lower()] = tw_user
+                self.tw_users.put(tw_user.screen_name.lower(), tw_user)
 
-        return db_user
+        return resolved, failed
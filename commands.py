@@ -1,20 +1,28 @@
 import json
+from collections import OrderedDict
 from datetime import datetime
 
 from pytz import timezone
 from pytz.exceptions import UnknownTimeZoneError
 import telegram
+from peewee import fn
 from telegram.ext import CallbackContext
 # from telegram.emoji import Emoji
 import tweepy
 from tweepy.auth import OAuthHandler
 from tweepy.errors import TweepyException
 
-from models import Subscription, TelegramChat
-from util import with_touched_chat, escape_markdown, markdown_twitter_usernames
+from models import Subscription, TelegramChat, TwitterUser, write_transaction
+from util import with_touched_chat, escape_markdown, markdown_twitter_usernames, lookup_users
 
 TIMEZONE_LIST_URL = "https://en.wikipedia.org/wiki/List_of_tz_database_time_zones"
 
+# Telegram's message length limit
+MESSAGE_MAX_LENGTH = 4096
+# friends/ids and followers/ids return up to 5000 ids per page, users/lookup takes 100
+EXPORT_IDS_PAGE = 5000
+EXPORT_LOOKUP_CHUNK = 100
+
 
 def cmd_ping(update: telegram.Update, _: CallbackContext) -> None:
     update.message.reply_text('Pong!')
@@ -52,7 +60,8 @@ This bot is free open source software, check /source if you want to host it!
         parse_mode=telegram.ParseMode.MARKDOWN)
 
 
-def cmd_sub(update: telegram.Update, context: CallbackContext) -> None:
+def subscribe(update: telegram.Update, context: CallbackContext, command, sub_kind) -> None:
+    """Subscribe the chat to every username in the command's args with one lookup and one insert"""
     args = context.args
     bot = context.bot
     chat, _created = TelegramChat.get_or_create(
@@ -60,135 +69,51 @@ def cmd_sub(update: telegram.Update, context: CallbackContext) -> None:
         tg_type=update.message.chat.type,
     )
     if len(args) < 1:
-        bot.reply(update, "Use /sub username1 username2 username3 ...")
+        bot.reply(update, "Use /{} username1 username2 username3 ...".format(command))
         return
-    tw_usernames = args
+    # each name once, however it's capitalized
+    tw_usernames = list(OrderedDict((name.lower(), name) for name in args).values())
     not_found = []
     already_subscribed = []
     successfully_subscribed = []
 
-    for tw_username in tw_usernames:
-        tw_user = bot.get_tw_user(tw_username)
-
-        if tw_user is None:
-            not_found.append(tw_username)
-            continue
-
-        if Subscription.select().where(
-                Subscription.tw_user == tw_user,
-                Subscription.tg_chat == chat).count() == 1:
-            already_subscribed.append(tw_user.full_name)
-            continue
-
-        Subscription.create(tg_chat=chat, tw_user=tw_user, sub_kind=0)
-        successfully_subscribed.append(tw_user.full_name)
-
-    reply = ""
-
-    if len(not_found) != 0:
-        reply += "Sorry, I didn't find username{} {}\n\n".format(
-            "" if len(not_found) == 1 else "s",
-            ", ".join(not_found)
-        )
-
-    if len(already_subscribed) != 0:
-        reply += "You're already subscribed to {}\n\n".format(
-            ", ".join(already_subscribed)
-        )
-
-    if len(successfully_subscribed) != 0:
-        reply += "I've added your subscription to {}".format(
-            ", ".join(successfully_subscribed)
-        )
-
-    bot.reply(update, reply)
-
-
-def cmd_sub_no_rt(update: telegram.Update, context: CallbackContext) -> None:
-    args = context.args
-    bot = context.bot
-    chat, _created = TelegramChat.get_or_create(
-        chat_id=update.message.chat.id,
-        tg_type=update.message.chat.type,
-    )
-    if len(args) < 1:
-        bot.reply(update, "Use /sub_no_rt username1 username2 username3 ...")
-        return
-    tw_usernames = args
-    not_found = []
-    already_subscribed = []
-    successfully_subscribed = []
+    tw_users, failed = bot.get_tw_users(tw_usernames)
+    failed = set(failed)
+    subscribed = set(tw_user_id for (tw_user_id,) in Subscription
+                     .select(Subscription.tw_user)
+                     .where(Subscription.tg_chat == chat,
+                            Subscription.tw_user << [tw_user.id for tw_user in tw_users.values()])
+                     .tuples())
 
+    new_rows = []
     for tw_username in tw_usernames:
-        tw_user = bot.get_tw_user(tw_username)
+        tw_user = tw_users.get(tw_username.lower())
 
         if tw_user is None:
-            not_found.append(tw_username)
+            if tw_username.lower() not in failed:
+                not_found.append(tw_username)
             continue
 
-        if Subscription.select().where(
-                Subscription.tw_user == tw_user,
-                Subscription.tg_chat == chat).count() == 1:
+        if tw_user.id in subscribed:
             already_subscribed.append(tw_user.full_name)
             continue
 
-        Subscription.create(tg_chat=chat, tw_user=tw_user, sub_kind=1)
+        subscribed.add(tw_user.id)
+        new_rows.append({'tg_chat': chat.id, 'tw_user': tw_user.id, 'sub_kind': sub_kind})
         successfully_subscribed.append(tw_user.full_name)
 
-    reply = ""
+    with write_transaction():
+        for i in range(0, len(new_rows), 100):
+            # the pair is unique, a concurrent /sub may have inserted it already
+            Subscription.insert_many(new_rows[i:i + 100]).on_conflict_ignore().execute()
 
-    if len(not_found) != 0:
-        reply += "Sorry, I didn't find username{} {}\n\n".format(
-            "" if len(not_found) == 1 else "s",
-            ", ".join(not_found)
-        )
+    reply = ""
 
-    if len(already_subscribed) != 0:
-        reply += "You're already subscribed to {}\n\n".format(
-            ", ".join(already_subscribed)
+    if len(failed) != 0:
+        reply += "Sorry, I couldn't look up {} right now, try again later\n\n".format(
+            ", ".join(name for name in tw_usernames if name.lower() in failed)
         )
 
-    if len(successfully_subscribed) != 0:
-        reply += "I've added your subscription to {}".format(
-            ", ".join(successfully_subscribed)
-        )
-
-    bot.reply(update, reply)
-
-
-def cmd_sub_no_reply(update: telegram.Update, context: CallbackContext) -> None:
-    args = context.args
-    bot = context.bot
-    chat, _created = TelegramChat.get_or_create(
-        chat_id=update.message.chat.id,
-        tg_type=update.message.chat.type,
-    )
-    if len(args) < 1:
-        bot.reply(update, "Use /sub_no_reply username1 username2 username3 ...")
-        return
-    tw_usernames = args
-    not_found = []
-    already_subscribed = []
-    successfully_subscribed = []
-
-    for tw_username in tw_usernames:
-        tw_user = bot.get_tw_user(tw_username)
-
-        if tw_user is None:
-            not_found.append(tw_username)
-            continue
-
-        if Subscription.select().where(
-                Subscription.tw_user == tw_user,
-                Subscription.tg_chat == chat).count() == 1:
-            already_subscribed.append(tw_user.full_name)
-            continue
-
-        Subscription.create(tg_chat=chat, tw_user=tw_user, sub_kind=2)
-        successfully_subscribed.append(tw_user.full_name)
-
-    reply = ""
-
     if len(not_found) != 0:
         reply += "Sorry, I didn't find username{} {}\n\n".format(
             "" if len(not_found) == 1 else "s",
@@ -208,56 +133,20 @@ def cmd_sub_no_reply(update: telegram.Update, context: CallbackContext) -> None:
     bot.reply(update, reply)
 
 
-def cmd_mediasub(update: telegram.Update, context: CallbackContext) -> None:
-    args = context.args
-    bot = context.bot
-    chat, _created = TelegramChat.get_or_create(
-        chat_id=update.message.chat.id,
-        tg_type=update.message.chat.type,
-    )
-    if len(args) < 1:
-        bot.reply(update, "Use /sub_no_reply username1 username2 username3 ...")
-        return
-    tw_usernames = args
-    not_found = []
-    already_subscribed = []
-    successfully_subscribed = []
-
-    for tw_username in tw_usernames:
-        tw_user = bot.get_tw_user(tw_username)
-
-        if tw_user is None:
-            not_found.append(tw_username)
-            continue
+def cmd_sub(update: telegram.Update, context: CallbackContext) -> None:
+    subscribe(update, context, 'sub', 0)
 
-        if Subscription.select().where(
-                Subscription.tw_user == tw_user,
-                Subscription.tg_chat == chat).count() == 1:
-            already_subscribed.append(tw_user.full_name)
-            continue
 
-        Subscription.create(tg_chat=chat, tw_user=tw_user, sub_kind=3)
-        successfully_subscribed.append(tw_user.full_name)
-
-    reply = ""
+def cmd_sub_no_rt(update: telegram.Update, context: CallbackContext) -> None:
+    subscribe(update, context, 'sub_no_rt', 1)
 
-    if len(not_found) != 0:
-        reply += "Sorry, I didn't find username{} {}\n\n".format(
-            "" if len(not_found) == 1 else "s",
-            ", ".join(not_found)
-        )
 
-    if len(already_subscribed) != 0:
-        reply += "You're already subscribed to {}\n\n".format(
-            ", ".join(already_subscribed)
-        )
+def cmd_sub_no_reply(update: telegram.Update, context: CallbackContext) -> None:
+    subscribe(update, context, 'sub_no_reply', 2)
 
-    if len(successfully_subscribed) != 0:
-        reply += "I've added your subscription to {}".format(
-            ", ".join(successfully_subscribed)
-        )
 
-    bot.reply(update, reply)
+def cmd_mediasub(update: telegram.Update, context: CallbackContext) -> None:
+    subscribe(update, context, 'mediasub', 3)
 
 
 def cmd_unsub(update: telegram.Update, context: CallbackContext) -> None:
@@ -270,24 +159,26 @@ def cmd_unsub(update: telegram.Update, context: CallbackContext) -> None:
     if len(args) < 1:
         bot.reply(update, "Use /unsub username1 username2 username3 ...")
         return
-    tw_usernames = args
+    tw_usernames = list(OrderedDict((name.lower(), name) for name in args).values())
     not_found = []
     successfully_unsubscribed = []
 
-    for tw_username in tw_usernames:
-        tw_user = bot.get_tw_user(tw_username)
+    # only subscribed accounts can be unsubscribed, so the database knows them all
+    subscriptions = {s.tw_user.screen_name.lower(): s for s in
+                     Subscription.select(Subscription, TwitterUser).join(TwitterUser)
+                     .where(Subscription.tg_chat == chat,
+                            fn.LOWER(TwitterUser.screen_name) << [n.lower() for n in tw_usernames])}
 
-        if tw_user is None or Subscription.select().where(
-                Subscription.tw_user == tw_user,
-                Subscription.tg_chat == chat).count() == 0:
+    for tw_username in tw_usernames:
+        s = subscriptions.get(tw_username.lower())
+        if s is None:
             not_found.append(tw_username)
             continue
+        successfully_unsubscribed.append(s.tw_user.full_name)
 
+    if subscriptions:
         Subscription.delete().where(
-            Subscription.tw_user == tw_user,
-            Subscription.tg_chat == chat).execute()
-
-        successfully_unsubscribed.append(tw_user.full_name)
+            Subscription.id << [s.id for s in subscriptions.values()]).execute()
 
     reply = ""
 
@@ -461,7 +352,12 @@ def cmd_verify(update: telegram.Update, context: CallbackContext) -> None:
     #cmd_set_timezone(bot, update, [tz_name])
 
 
-def cmd_export_friends(update: telegram.Update, context: CallbackContext) -> None:
+def export_accounts(update: telegram.Update, context: CallbackContext, ids_method, intro) -> None:
+    """
+    Send /sub commands for the accounts an ids endpoint pages through. Names are
+    resolved a lookup at a time and sent as soon as a message is full, so
+    memory and message size stay bounded however many accounts there are.
+    """
     bot = context.bot
     chat, _created = TelegramChat.get_or_create(
         chat_id=update.message.chat.id,
@@ -475,29 +371,34 @@ def cmd_export_friends(update: telegram.Update, context: CallbackContext) -> Non
         return
     bot_auth = bot.tw.auth
     api = chat.tw_api(bot_auth.consumer_key, bot_auth.consumer_secret)
-    screen_names = [f.screen_name for f in tweepy.Cursor(api.friends, count=200).items()]
-    bot.reply(update, "Use this to subscribe to all your Twitter friends:")
-    bot.reply(update, "/sub {}".format(" ".join(screen_names)))
+    bot.reply(update, intro)
+
+    message = "/sub"
+    try:
+        for page in tweepy.Cursor(getattr(api, ids_method), count=EXPORT_IDS_PAGE).pages():
+            for i in range(0, len(page), EXPORT_LOOKUP_CHUNK):
+                for tw_user in lookup_users(api, user_id=page[i:i + EXPORT_LOOKUP_CHUNK]):
+                    if len(message) + 1 + len(tw_user.screen_name) > MESSAGE_MAX_LENGTH:
+                        bot.reply(update, message)
+                        message = "/sub"
+                    message += " " + tw_user.screen_name
+    except TweepyException as e:
+        if message != "/sub":
+            bot.reply(update, message)
+        bot.reply(update, "Twitter stopped the export early ({}), try again later".format(e))
+        return
+    if message != "/sub":
+        bot.reply(update, message)
+
+
+def cmd_export_friends(update: telegram.Update, context: CallbackContext) -> None:
+    export_accounts(update, context, 'get_friend_ids',
+                    "Use this to subscribe to all your Twitter friends:")
 
 
 def cmd_export_followers(update: telegram.Update, context: CallbackContext) -> None:
-    bot = context.bot
-    chat, _created = TelegramChat.get_or_create(
-        chat_id=update.message.chat.id,
-        tg_type=update.message.chat.type,
-    )
-    if not chat.is_authorized:
-        if not chat.twitter_request_token:
-            bot.reply(update, "You have not authorized yet. Use /auth to do it")
-        else:
-            bot.reply(update, "You have not verified your authorization yet. Use /verify code to do it")
-        return
-    bot_auth = bot.tw.auth
-    api = chat.tw_api(bot_auth.consumer_key, bot_auth.consumer_secret)
-    me = api.me()
-    screen_names = [f.screen_name for f in tweepy.Cursor(api.followers, count=200).items()]
-    bot.reply(update, "Use this to subscribe to all your Twitter subscriptions:")
-    bot.reply(update, "/sub {}".format(" ".join(screen_names)))
+    export_accounts(update, context, 'get_follower_ids',
+                    "Use this to subscribe to all your Twitter subscriptions:")
 
 
 def cmd_set_timezone(update: telegram.Update, context: CallbackContext) -> None:
@@ -0,0 +1,10 @@
+"""Optional tuning knobs, read from the env dict in secrets.py"""
+
+try:
+    from secrets import env
+except ImportError:
+    env = {}
+
+
+def get(name, default=None):
+    return env.get(name, default)
@@ -0,0 +1,123 @@
+"""
+Spreads timeline fetches over every Twitter token the bot can use.
+
+The bot's own (app) token and the tokens of chats that ran /auth + /verify
+each have a separate rate-limit budget. Every response's x-rate-limit-*
+headers update the budget of the token that made it, and each fetch goes to
+the token with the most calls left. Tokens Twitter rejects are evicted.
+"""
+import logging
+import time
+from threading import Lock
+from urllib.parse import urlparse
+
+from models import TelegramChat
+
+USER_TIMELINE = '/1.1/statuses/user_timeline.json'
+LIST_TIMELINE = '/1.1/lists/statuses.json'
+HOME_TIMELINE = '/1.1/statuses/home_timeline.json'
+
+# budgets per 15 minute window before a token's first response tells us better
+DEFAULT_LIMITS = {
+    'app': {USER_TIMELINE: 1500, LIST_TIMELINE: 900},
+    'user': {USER_TIMELINE: 900, LIST_TIMELINE: 900, HOME_TIMELINE: 15},
+}
+# "Invalid or expired token" and "Could not authenticate you"
+REVOKED_CODES = {89, 32}
+
+logger = logging.getLogger(__name__)
+
+
+class Credential(object):
+    def __init__(self, api, kind, chat_id=None):
+        self.api = api
+        self.kind = kind
+        self.chat_id = chat_id
+        self._lock = Lock()
+        # endpoint path -> [calls left, reset time]
+        self._limits = {}
+        api.session.hooks['response'].append(self._track)
+
+    def __repr__(self):
+        return "<Credential {} {}>".format(self.kind, self.chat_id or '')
+
+    def _track(self, resp, *args, **kwargs):
+        remaining = resp.headers.get('x-rate-limit-remaining')
+        reset = resp.headers.get('x-rate-limit-reset')
+        if remaining is None or reset is None:
+            return
+        with self._lock:
+            self._limits[urlparse(resp.url).path] = [int(remaining), int(reset)]
+
+    def headroom(self, endpoint, now=None):
+        now = now or time.time()
+        with self._lock:
+            limit = self._limits.get(endpoint)
+            if limit is None or limit[1] <= now:
+                return DEFAULT_LIMITS[self.kind].get(endpoint, 0)
+            return limit[0]
+
+    def reserve(self, endpoint):
+        """Count a call against the budget until its response updates it"""
+        now = time.time()
+        with self._lock:
+            limit = self._limits.get(endpoint)
+            if limit is None or limit[1] <= now:
+                limit = [DEFAULT_LIMITS[self.kind].get(endpoint, 0), now + 15 * 60]
+                self._limits[endpoint] = limit
+            limit[0] -= 1
+
+
+class CredentialPool(object):
+    def __init__(self, app_api):
+        self.app = Credential(app_api, 'app')
+        self._users = {}
+        self._lock = Lock()
+
+    def refresh(self):
+        """Pick up chats that authorized since the last cycle and drop the ones that left"""
+        auth = self.app.api.auth
+        chats = TelegramChat.select().where(TelegramChat.twitter_token.is_null(False),
+                                            TelegramChat.twitter_secret.is_null(False),
+                                            TelegramChat.delete_soon == False)
+        current = {}
+        for chat in chats:
+            credential = self._users.get(chat.chat_id)
+            if credential is None:
+                api = chat.tw_api(auth.consumer_key, auth.consumer_secret)
+                credential = Credential(api, 'user', chat.chat_id)
+            current[chat.chat_id] = credential
+        with self._lock:
+            self._users = current
+
+    def __len__(self):
+        return 1 + len(self._users)
+
+    def user(self, chat_id):
+        """The credential of an authorized chat, if it is still usable"""
+        with self._lock:
+            return self._users.get(chat_id)
+
+    def acquire(self, endpoint):
+        """The credential with the most calls left on the endpoint, or None if all are spent"""
+        with self._lock:
+            credentials = [self.app] + list(self._users.values())
+            best = max(credentials, key=lambda c: c.headroom(endpoint))
+            if best.headroom(endpoint) <= 0:
+                return None
+            best.reserve(endpoint)
+            return best
+
+    def evict(self, credential):
+        """Forget a user token Twitter doesn't accept anymore"""
+        if credential.kind != 'user':
+            return
+        with self._lock:
+            self._users.pop(credential.chat_id, None)
+        logger.info("Evicting the Twitter token of chat {}".format(credential.chat_id))
+        TelegramChat.update(twitter_token=None, twitter_secret=None) \
+            .where(TelegramChat.chat_id == credential.chat_id).execute()
+
+
+def is_revoked(error):
+    return bool(REVOKED_CODES & set(getattr(error, 'api_codes', None) or ()))
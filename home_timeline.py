@@ -0,0 +1,139 @@
+import logging
+import time
+from datetime import timedelta
+
+import tweepy
+
+import config
+from credentials import HOME_TIMELINE, is_revoked
+from models import TwitterUser, Subscription, TelegramChat
+from sharding import shard_of
+
+HOME_PAGE_COUNT = 200
+HOME_MAX_PAGES = 4  # home_timeline only reaches back 800 tweets anyway
+FRIENDS_TTL = 60 * 60
+
+logger = logging.getLogger(__name__)
+
+# chat_id -> (expires_at, set of followed twitter ids)
+_friend_ids = {}
+# chat_id -> ids of the TwitterUsers its last home poll covered
+_covered = {}
+
+
+def followed_ids(api, chat):
+    cached = _friend_ids.get(chat.chat_id)
+    if cached is not None and cached[0] > time.time():
+        return cached[1]
+
+    ids = set()
+    for page in tweepy.Cursor(api.get_friend_ids, count=5000).pages():
+        ids.update(page)
+    _friend_ids[chat.chat_id] = (time.time() + FRIENDS_TTL, ids)
+    return ids
+
+
+def fetch_home_tweets(api, chat, started_at):
+    """
+    Fetch the new tweets on an authorized chat's home timeline.
+
+    Returns the subscribed accounts whose tweets are fully covered by this
+    poll, mapped to their new tweets. Those accounts don't need their own
+    user_timeline call in this cycle.
+    """
+    tweets = []
+    max_id = None
+    complete = False
+    if not chat.home_last_tweet_id:
+        # the first poll only needs the newest tweet for the high-water mark
+        tweets = list(api.home_timeline(count=1, tweet_mode='extended'))
+    else:
+        for _ in range(HOME_MAX_PAGES):
+            page = api.home_timeline(
+                since_id=chat.home_last_tweet_id,
+                max_id=max_id,
+                count=HOME_PAGE_COUNT,
+                tweet_mode='extended')
+            tweets.extend(page)
+            if len(page) < HOME_PAGE_COUNT:
+                complete = True
+                break
+            max_id = page[-1].id - 1
+
+    previous_poll = chat.home_polled_at
+    if tweets:
+        chat.home_last_tweet_id = max(chat.home_last_tweet_id, max(t.id for t in tweets))
+    chat.home_polled_at = started_at
+    chat.save()
+
+    # the first poll only sets the high-water mark, and a window that hit the
+    # page cap may have skipped tweets: let the per-user polling handle those
+    if previous_poll is None or not chat.home_last_tweet_id or not complete:
+        return {}
+
+    # the chat sees protected accounts its user follows, their tweets are not
+    # for every subscriber: those accounts stay with user_timeline, whose 401
+    # cleans them up
+    friends = followed_ids(api, chat) - {t.user.id for t in tweets if t.user.protected}
+    covered = {u: [] for u in (TwitterUser.select()
+                               .join(Subscription)
+                               .where(Subscription.tg_chat == chat,
+                                      TwitterUser.last_fetched >= previous_poll)
+                               .group_by(TwitterUser))
+               if u.tw_id in friends}
+    by_id = {u.tw_id: u for u in covered}
+    for tweet in tweets:
+        tw_user = by_id.get(tweet.user.id)
+        if tw_user is not None:
+            covered[tw_user].append(tweet)
+
+    logger.debug("Home timeline of chat {} covered {} accounts".format(
+        chat.chat_id, len(covered)))
+    return covered
+
+
+def poll_home_timelines(credentials, started_at, shards=None):
+    """
+    Poll the home timelines of the authorized chats that are due, only the
+    chats in `shards` if given.
+
+    Returns the accounts covered by the polls mapped to their new tweets, and
+    the ids of every account that is covered by some home timeline and can
+    skip its user_timeline call this cycle.
+    """
+    interval = timedelta(seconds=config.get('HOME_INTERVAL', 60))
+    grouped = {}
+    skip = set()
+    chats = TelegramChat.select().where(TelegramChat.twitter_token.is_null(False),
+                                        TelegramChat.twitter_secret.is_null(False),
+                                        TelegramChat.delete_soon == False)
+    if shards is not None:
+        chats = chats.where(shard_of(TelegramChat.id) << list(shards))
+    for chat in chats:
+        credential = credentials.user(chat.chat_id)
+        if credential is None:
+            continue
+
+        if (chat.home_polled_at is not None and chat.home_polled_at > started_at - interval
+                or credential.headroom(HOME_TIMELINE) < 1):
+            # not due yet or out of budget, its next poll picks up where the
+            # last one stopped
+            skip.update(_covered.get(chat.chat_id, ()))
+            continue
+
+        try:
+            covered = fetch_home_tweets(credential.api, chat, started_at)
+        except tweepy.errors.TweepyException as e:
+            logger.info("Couldn't poll the home timeline of chat {}: {}".format(
+                chat.chat_id, e))
+            _covered.pop(chat.chat_id, None)
+            if isinstance(e, tweepy.errors.Unauthorized) and is_revoked(e):
+                credentials.evict(credential)
+            continue
+
+        _covered[chat.chat_id] = {u.id for u in covered}
+        skip.update(_covered[chat.chat_id])
+        for tw_user, tweets in covered.items():
+            grouped.setdefault(tw_user, []).extend(tweets)
+
+    return grouped, skip
@@ -2,22 +2,234 @@ import html
 import logging
 import math
 import re
-from datetime import datetime
-from threading import Event
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from threading import Event, Lock
 
 import tweepy
+from peewee import fn, Value, IntegrityError, SqliteDatabase
 from telegram.error import TelegramError
 from telegram.ext import Job, CallbackContext
 
-from models import TwitterUser, Tweet, Subscription, db, TelegramChat
+import config
+from models import (db, TwitterUser, Tweet, Subscription, write_transaction, TelegramChat,
+                    TwitterList, Outbox, TweetMedia, JobState, closes_connection)
+from home_timeline import poll_home_timelines
+from credentials import USER_TIMELINE, LIST_TIMELINE, is_revoked
+from bot import Retry
+from sharding import shard_of
+from scheduler import due_users, cycle_budget, cycle_interval, plan_next_poll
+from twitter_lists import sync_lists, fetch_list_tweets, LIST_MAX_PAGES
+from util import metrics, lookup_users
 
 INFO_CLEANUP = {
     'NOTFOUND': "Your subscription to @{} was removed because that profile doesn't exist anymore. Maybe the account's name changed?",
     'PROTECTED': "Your subscription to @{} was removed because that profile is protected and can't be fetched.",
 }
 
+FETCH_JOB = 'fetch'
+_fetch_lock = Lock()
+
+# users whose new tweets are queued per statement
+FANOUT_CHUNK = 500
+
+# RefreshTwitterUsersJob looks up REFRESH_CHUNK accounts per call, at most
+# REFRESH_CALLS times per run
+REFRESH_CHUNK = 100
+REFRESH_CALLS = 30
+
+# id of the last account refreshed, the next run continues after it
+_refresh_after = 0
+
+# CompactTweetsJob keeps tweets at least TWEET_RETENTION seconds, and deletes
+# the others COMPACT_CHUNK per transaction
+TWEET_RETENTION = 24 * 60 * 60
+COMPACT_CHUNK = 1000
+
+DELIVERY_MAX_ATTEMPTS = 5
+DELIVERY_RETRY_DELAY = 5
+
+def media_row(tw_id, position, kind, url, entity=None, bitrate=None):
+    """A row for TweetMedia.insert_many, sized from the media entity if there is one"""
+    size = (entity or {}).get('sizes', {}).get('large', {})
+    return {'tweet': tw_id, 'position': position, 'kind': kind, 'url': url,
+            'bitrate': bitrate, 'width': size.get('w'), 'height': size.get('h')}
+
+
+def tweet_row(tweet, tw_user, logger):
+    """Turn a fetched tweepy status into a row for Tweet.insert_batch"""
+    # Check if tweet contains media, else check if it contains a link to an image
+    extensions = ('.jpg', '.jpeg', '.png', '.gif')
+    pattern = '[(%s)]$' % ')('.join(extensions)
+    media = []
+    tweet_text = html.unescape(tweet.full_text)
+    if 'media' in tweet.entities:
+        for position, imgs in enumerate(tweet.extended_entities['media']):
+            media.append(media_row(tweet.id, position, 'photo', imgs['media_url_https'], imgs))
+        try:
+            first = tweet.extended_entities['media'][0]
+            if 'video_info' in first:
+                variants = [v for v in first['video_info']['variants'] if 'bitrate' in v]
+                if variants:
+                    best = max(variants, key=lambda v: v['bitrate'])
+                    media.append(media_row(tweet.id, 0, 'video', best['url'], first,
+                                           best['bitrate']))
+        except (KeyError, IndexError, TypeError):
+            logger.warning("{} Finding video failed".format(tweet.id))
+    else:
+        for url_entity in tweet.entities['urls']:
+            expanded_url = url_entity['expanded_url']
+            if re.search(pattern, expanded_url):
+                media.append(media_row(tweet.id, 0, 'photo', expanded_url))
+                break
+    if media:
+        logger.debug("- - Found media URL in tweet: " + media[0]['url'])
+
+    for url_entity in tweet.entities['urls']:
+        expanded_url = url_entity['expanded_url']
+        indices = url_entity['indices']
+        display_url = tweet.full_text[indices[0]:indices[1]]
+        tweet_text = tweet_text.replace(display_url, expanded_url)
+
+    created_at = tweet.created_at
+    if created_at.tzinfo is not None:
+        # stored as naive UTC, every database keeps that the same way
+        created_at = created_at.astimezone(timezone.utc).replace(tzinfo=None)
+
+    tw_data = {
+        'tw_id': tweet.id,
+        'text': tweet_text,
+        'created_at': created_at,
+        'twitter_user': tw_user,
+        'media': media,
+    }
+    return tw_data
+
+
+def status_code(error):
+    """The HTTP status of a failed API call, None when no response came (timeouts, resets)"""
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', None)
+
+
+def user_timeline(api, tw_user, logger):
+    if tw_user.last_tweet_id == 0:
+        # get just the latest tweet
+        logger.debug(
+            "Fetching latest tweet by {}".format(tw_user.screen_name))
+        return api.user_timeline(
+            screen_name=tw_user.screen_name,
+            count=1,
+            tweet_mode='extended')
+
+    # get the fresh tweets
+    logger.debug(
+        "Fetching new tweets from {}".format(tw_user.screen_name))
+    return api.user_timeline(
+        screen_name=tw_user.screen_name,
+        since_id=tw_user.last_tweet_id,
+        tweet_mode='extended')
+
+
+def fetch_timeline(credentials, tw_user, stop, logger):
+    """Fetch a user's new tweets, or None when the cycle ran out of budget"""
+    while not stop.is_set():
+        credential = credentials.acquire(USER_TIMELINE)
+        if credential is None:
+            break
+
+        try:
+            tweets = user_timeline(credential.api, tw_user, logger)
+        except tweepy.errors.Unauthorized as e:
+            if credential.kind != 'user':
+                raise
+            if is_revoked(e):
+                # that token is dead, not the account: try again with another one
+                credentials.evict(credential)
+                continue
+            # maybe the account only blocked that token's owner, the app
+            # token tells whether it is really protected
+            return app_timeline(credentials, tw_user, logger)
+
+        if credential.kind == 'user' and any(t.user.protected for t in tweets):
+            # the token's owner follows a protected account: its tweets are
+            # not for every subscriber, the app token gets the 401 cleanup
+            return app_timeline(credentials, tw_user, logger)
+        return tweets
+
+    stop.set()
+    return None
+
+
+def app_timeline(credentials, tw_user, logger):
+    credentials.app.reserve(USER_TIMELINE)
+    return user_timeline(credentials.app.api, tw_user, logger)
+
+
+def pending_deliveries(user_ids, now):
+    """Outbox rows of the tweets of these users that their subscriptions haven't had yet"""
+    return (Subscription
+            .select(Subscription.tg_chat, Tweet.id, Subscription.sub_kind,
+                    Value(now), Value(0), Value(now), Value(False))
+            .join(TwitterUser, on=(Subscription.tw_user == TwitterUser.id))
+            .join(Tweet, on=(Tweet.twitter_user == TwitterUser.id))
+            .where(Subscription.tw_user << user_ids,
+                   TwitterUser.last_tweet_id > Subscription.last_tweet_id,
+                   ((Subscription.last_tweet_id == 0) &
+                    (Tweet.tw_id == TwitterUser.last_tweet_id)) |
+                   ((Subscription.last_tweet_id != 0) &
+                    (Tweet.tw_id > Subscription.last_tweet_id)))
+            .order_by(Tweet.tw_id, Subscription.id))
+
+
+def queue_new_tweets(user_ids):
+    """
+    Queue the tweets of these users that their subscriptions haven't had yet,
+    and advance the subscriptions to the newest tweet queued. A subscription
+    that never got a tweet only gets the newest one. Runs in a write_transaction.
+    """
+    if db.for_update:
+        # SQLite's IMMEDIATE transactions run one at a time, elsewhere lock the
+        # accounts and then their subscriptions, in id order: another worker
+        # fanning out the same accounts waits for this one and then sees the
+        # subscriptions advanced. The accounts' tweets and last_tweet_id are
+        # stored in one transaction, which can't commit while this one holds
+        # the accounts
+        list(TwitterUser.select(TwitterUser.id).where(TwitterUser.id << user_ids)
+             .order_by(TwitterUser.id).for_update())
+        list(Subscription.select(Subscription.id).where(Subscription.tw_user << user_ids)
+             .order_by(Subscription.id).for_update())
+
+    pending = pending_deliveries(user_ids, datetime.now())
+    Outbox.insert_from(pending, [Outbox.tg_chat, Outbox.tweet, Outbox.sub_kind, Outbox.known_at,
+                                 Outbox.attempts, Outbox.next_attempt_at,
+                                 Outbox.text_sent]).execute()
+
+    # the newest tweet of the account queued for the chat, not the account's
+    # last_tweet_id: a tweet stored meanwhile waits for the next fan-out
+    queued = (Outbox.select(fn.MAX(Tweet.tw_id))
+              .join(Tweet)
+              .where(Outbox.tg_chat == Subscription.tg_chat,
+                     Tweet.twitter_user == Subscription.tw_user))
+    (Subscription.update(last_tweet_id=queued)
+     .where(Subscription.tw_user << user_ids, Subscription.last_tweet_id < queued)
+     .execute())
+
 
 def FetchAndSendTweetsJob(context_in: CallbackContext) -> None:
+    # single flight: two cycles at once would queue the same tweets twice
+    if not _fetch_lock.acquire(blocking=False):
+        logging.getLogger(FetchAndSendTweetsJob.__name__).info(
+            "The previous cycle is still running, skipping this one")
+        return
+    try:
+        fetch_and_send_tweets(context_in)
+    finally:
+        _fetch_lock.release()
+
+
+def fetch_and_send_tweets(context_in: CallbackContext) -> None:
     job = context_in.job
     bot = context_in.bot
     job.repeat = True
@@ -28,159 +240,165 @@ def FetchAndSendTweetsJob(context_in: CallbackContext) -> None:
     job._enabled.set()
     job.logger = logging.getLogger(job.name)
     job.logger.debug("Fetching tweets...")
-    tweet_rows = []
-    # fetch the tw users' tweets
-    tw_users = list((TwitterUser.select()
-                     .join(Subscription)
-                     .group_by(TwitterUser)
-                     .order_by(TwitterUser.last_fetched)))
+    started_at = datetime.now()
+    shards = bot.shards
+    owned = None
+    job_name = FETCH_JOB
+    if shards is not None:
+        # a worker process only fetches the shards it holds a lease on
+        owned = shards.owned
+        if not owned:
+            job.logger.debug("- No shards leased yet, skipping this cycle.")
+            return
+        job_name = '{}:{}'.format(FETCH_JOB, shards.name)
+    state = JobState.load(job_name)
+    if state.started_at is not None and (state.finished_at is None or
+                                         state.finished_at < state.started_at):
+        # the due queue in TwitterUser.next_poll_at is the cycle's cursor: the
+        # accounts the interrupted cycle didn't get to are still first in line
+        job.logger.info("The last cycle was interrupted, resuming from its next account")
+    interval = cycle_interval(state.duration)
+    state.started_at = started_at
+    state.save()
     updated_tw_users = []
     users_to_cleanup = []
-
-    for tw_user in tw_users:
-        try:
-            if tw_user.last_tweet_id == 0:
-                # get just the latest tweet
-                job.logger.debug(
-                    "Fetching latest tweet by {}".format(tw_user.screen_name))
-                tweets = bot.tw.user_timeline(
-                    screen_name=tw_user.screen_name,
-                    count=1,
-                    tweet_mode='extended')
-            else:
-                # get the fresh tweets
-                job.logger.debug(
-                    "Fetching new tweets from {}".format(tw_user.screen_name))
-                tweets = bot.tw.user_timeline(
-                    screen_name=tw_user.screen_name,
-                    since_id=tw_user.last_tweet_id,
-                    tweet_mode='extended')
-            updated_tw_users.append(tw_user)
-        except tweepy.errors.TweepyException as e:
-            sc = e.response.status_code
-            if sc == 429:
-                job.logger.debug("- Hit ratelimit, breaking.")
+    seen_ids = set()
+    fetched = 0
+    duplicates = 0
+
+    def store(grouped, planned=False):
+        """
+        Write a poll's tweets and its accounts' polling state in a short
+        transaction of their own, as soon as the poll is done: an interrupted
+        cycle keeps what it got and the next one goes on with the accounts
+        still due
+        """
+        nonlocal fetched, duplicates
+        rows = []
+        for tw_user, tweets in grouped.items():
+            for tweet in tweets:
+                if tweet.id in seen_ids:
+                    continue
+                seen_ids.add(tweet.id)
+                job.logger.debug("- Got tweet: {}".format(tweet.full_text))
+                rows.append(tweet_row(tweet, tw_user, job.logger))
+
+        with write_transaction():
+            for i in range(0, len(rows), 100):
+                duplicates += Tweet.insert_batch(rows[i:i + 100])
+            if planned:
+                for tw_user, tweets in grouped.items():
+                    rate, next_poll_at = plan_next_poll(tw_user, len(tweets), started_at)
+                    TwitterUser.update(tweet_rate=rate, next_poll_at=next_poll_at, list_gap=False) \
+                        .where(TwitterUser.id == tw_user.id).execute()
+            TwitterUser.update(last_fetched=started_at) \
+                .where(TwitterUser.id << [tw_user.id for tw_user in grouped]).execute()
+        fetched += len(rows)
+        updated_tw_users.extend(grouped)
+
+    covered = set()
+    # accounts polled through a list, whatever their shard
+    listed = set()
+    poll_lists = config.get('POLL_MODE', 'timeline') == 'lists'
+
+    bot.credentials.refresh()
+
+    if config.get('HOME_TIMELINE', False):
+        # authorized chats' home timelines cover the accounts they follow
+        grouped, covered = poll_home_timelines(bot.credentials, started_at, owned)
+        store(grouped)
+
+    if poll_lists:
+        # one list_timeline call covers up to LIST_MAX_MEMBERS accounts
+        if owned is None or 0 in owned:
+            # the lists are kept in sync by a single worker
+            sync_lists(bot.tw)
+        lists = TwitterList.select().order_by(TwitterList.polled_at, TwitterList.id)
+        if owned is not None:
+            lists = lists.where(shard_of(TwitterList.id) << list(owned))
+        for tw_list in lists:
+            if bot.credentials.app.headroom(LIST_TIMELINE) < LIST_MAX_PAGES:
+                # stop before running dry, the next cycle resumes with this list
+                job.logger.debug("- Out of list_timeline budget, breaking.")
                 break
-
-            if sc == 401:
-                users_to_cleanup.append((tw_user, 'PROTECTED'))
-                job.logger.debug("- Protected tweets here. Cleaning up this user")
-                continue
-
-            if sc == 404:
-                users_to_cleanup.append((tw_user, 'NOTFOUND'))
-                job.logger.debug("- 404? Maybe screen name changed? Cleaning up this user")
+            try:
+                grouped = fetch_list_tweets(bot.tw, tw_list)
+            except tweepy.errors.TweepyException as e:
+                sc = status_code(e)
+                if sc == 429:
+                    job.logger.debug("- Hit ratelimit, breaking.")
+                    break
+                job.logger.debug(
+                    "- Unknown exception on list {}, Status code {}".format(tw_list.name, sc))
                 continue
-
-            job.logger.debug(
-                "- Unknown exception, Status code {}".format(sc))
-            continue
-
-        for tweet in tweets:
-            job.logger.debug("- Got tweet: {}".format(tweet.full_text))
-
-            # Check if tweet contains media, else check if it contains a link to an image
-            extensions = ('.jpg', '.jpeg', '.png', '.gif')
-            pattern = '[(%s)]$' % ')('.join(extensions)
-            photo_url = []
-            video_url = ''
-            tweet_text = html.unescape(tweet.full_text)
-            if 'media' in tweet.entities:
-                for imgs in tweet.extended_entities['media']:
-                    photo_url.append(imgs['media_url_https'])
-                try:
-                    if 'video_info' in tweet.extended_entities['media'][0]:
-                        max_bit = 0
-                        for video_info in tweet.extended_entities['media'][0]['video_info']['variants']:
-                            if 'bitrate' in video_info:
-                                if(video_info['bitrate']>max_bit):
-                                    video_url = video_info['url']
-                                    max_bit = video_info['bitrate']
-                except:
-                    job.logger.warning(
-                        "{} Finding video failed, video url is in the video_url.txt...".format(tweet.id))
-            else:
-                for url_entity in tweet.entities['urls']:
-                    expanded_url = url_entity['expanded_url']
-                    if re.search(pattern, expanded_url):
-                        photo_url.append(expanded_url)
-                        break
-            if len(photo_url) != 0:
-                job.logger.debug("- - Found media URL in tweet: " + photo_url[0])
-
-            for url_entity in tweet.entities['urls']:
-                expanded_url = url_entity['expanded_url']
-                indices = url_entity['indices']
-                display_url = tweet.full_text[indices[0]:indices[1]]
-                tweet_text = tweet_text.replace(display_url, expanded_url)
-
-            tw_data = {
-                'tw_id': tweet.id,
-                'text': tweet_text,
-                'created_at': tweet.created_at,
-                'twitter_user': tw_user,
-                'photo_url': photo_url,
-                'video_url': video_url,
-            }
+            store(grouped)
+            listed.update(tw_user.id for tw_user in grouped)
+
+    # fetch the tw users' tweets, the most overdue ones first
+    budget = cycle_budget(len(bot.credentials), interval)
+    if shards is not None:
+        # the tokens' rate limits are shared by every worker
+        budget = max(1, budget // shards.workers)
+    tw_users = due_users(budget, skip=covered, unlisted_only=poll_lists, shards=owned)
+
+    # the API calls run on the pool, results are handled here in order
+    stop = Event()
+    with ThreadPoolExecutor(max_workers=config.get('FETCH_WORKERS', 4)) as pool:
+        fetch = closes_connection(fetch_timeline)
+        futures = [(tw_user, pool.submit(fetch, bot.credentials, tw_user, stop, job.logger))
+                   for tw_user in tw_users]
+        for tw_user, future in futures:
             try:
-                t = Tweet.get(Tweet.tw_id == tweet.id)
-                job.logger.warning("Got duplicated tw_id on this tweet:")
-                job.logger.warning(str(tw_data))
-            except Tweet.DoesNotExist:
-                tweet_rows.append(tw_data)
-
-            if len(tweet_rows) >= 100:
-                Tweet.insert_many(tweet_rows).execute()
-                tweet_rows = []
+                tweets = future.result()
+            except tweepy.errors.TweepyException as e:
+                sc = status_code(e)
+                if sc == 429:
+                    # the calls in flight still finish and their tweets are
+                    # kept, the ones not started yet return right away
+                    job.logger.debug("- Hit ratelimit, stopping.")
+                    stop.set()
+                    continue
 
-    TwitterUser.update(last_fetched=datetime.now()) \
-        .where(TwitterUser.id << [tw.id for tw in updated_tw_users]).execute()
+                if sc == 401:
+                    users_to_cleanup.append((tw_user, 'PROTECTED'))
+                    job.logger.debug("- Protected tweets here. Cleaning up this user")
+                    continue
 
-    if not updated_tw_users:
-        return
+                if sc == 404:
+                    users_to_cleanup.append((tw_user, 'NOTFOUND'))
+                    job.logger.debug("- 404? Maybe screen name changed? Cleaning up this user")
+                    continue
 
-    if tweet_rows:
-        Tweet.insert_many(tweet_rows).execute()
+                # no response (sc is None) is transient too: the account
+                # stays due for the next cycle
+                job.logger.debug(
+                    "- Unknown exception, Status code {}: {}".format(sc, e))
+                continue
 
-    # send the new tweets to subscribers
-    subscriptions = list(Subscription.select()
-                         .where(Subscription.tw_user << updated_tw_users))
-    for s in subscriptions:
-        # are there new tweets? send em all!
-        job.logger.debug(
-            "Checking subscription {} {}".format(s.tg_chat.chat_id, s.tw_user.screen_name))
+            if tweets is None:
+                # out of budget, the account stays due for the next cycle
+                continue
 
-        if s.last_tweet_id == 0:  # didn't receive any tweet yet
-            try:
-                tw = s.tw_user.tweets.select() \
-                    .order_by(Tweet.tw_id.desc()) \
-                    .first()
-                if tw is None:
-                    job.logger.warning("Something fishy is going on here...")
-                else:
-                    bot.send_tweet(s.tg_chat, tw, s.sub_kind)
-                    # save the latest tweet sent on this subscription
-                    s.last_tweet_id = tw.tw_id
-                    s.save()
-            except IndexError:
-                job.logger.debug("- No tweets available yet on {}".format(s.tw_user.screen_name))
-
-            continue
-
-        if s.tw_user.last_tweet_id > s.last_tweet_id:
-            job.logger.debug("- Some fresh tweets here!")
-            for tw in (s.tw_user.tweets.select()
-                                .where(Tweet.tw_id > s.last_tweet_id)
-                                .order_by(Tweet.tw_id.asc())
-                       ):
-                bot.send_tweet(s.tg_chat, tw, s.sub_kind)
-
-            # save the latest tweet sent on this subscription
-            s.last_tweet_id = s.tw_user.last_tweet_id
-            s.save()
-            continue
-
-        job.logger.debug("- No new tweets here.")
+            store({tw_user: tweets}, planned=True)
+
+    metrics.incr('tweets_fetched', fetched)
+    metrics.incr('tweets_duplicated', duplicates)
+    job.logger.debug("- Stored {} new tweets, {} were known already".format(
+        fetched - duplicates, duplicates))
+
+    # queue the new tweets for the subscribers, DeliverTweetsJob sends them.
+    # Tweets an interrupted cycle stored are queued when their account is
+    # polled next, its last_tweet_id is still ahead of the subscriptions
+    user_ids = list({tw_user.id for tw_user in updated_tw_users})
+    if shards is not None:
+        # the tweets of shards whose lease ran out meanwhile, or that a home
+        # timeline brought in from another worker's shards, are queued by
+        # their owner's next poll
+        owned = shards.owned
+        user_ids = [i for i in user_ids if i in listed or shards.shard(i) in owned]
+    with write_transaction():
+        for i in range(0, len(user_ids), FANOUT_CHUNK):
+            queue_new_tweets(user_ids[i:i + FANOUT_CHUNK])
 
     job.logger.debug("Starting tw_user cleanup")
     if not users_to_cleanup:
@@ -222,7 +440,8 @@ def FetchAndSendTweetsJob(context_in: CallbackContext) -> None:
                         chat.save()
 
         job.logger.debug("- Cleaning up TwitterUser @{} {}".format(tw_user.screen_name, reason))
-        tw_user.delete_instance()
+        # with its tweets, the database may enforce their foreign keys
+        tw_user.delete_instance(recursive=True)
 
         job.logger.debug("- Cleanup finished")
 
@@ -230,3 +449,217 @@ def FetchAndSendTweetsJob(context_in: CallbackContext) -> None:
     for chat in TelegramChat.select().where(TelegramChat.delete_soon == True):
         chat.delete_instance(recursive=True)
         job.logger.debug("Deleting chat {}".format(chat.chat_id))
+
+    state.finished_at = datetime.now()
+    state.duration = (state.finished_at - started_at).total_seconds()
+    state.save()
+    stretch_interval(job, state.duration, job.logger)
+    job.logger.info("Cycle took {:.0f}s. Since start: {}".format(state.duration, ', '.join(
+        '{} {}'.format(name, count) for name, count in sorted(metrics.snapshot().items()))))
+
+
+def HeartbeatJob(context_in: CallbackContext) -> None:
+    """Renew this worker's shard leases and rebalance them with the other workers"""
+    context_in.bot.shards.heartbeat()
+
+
+def stretch_interval(job, duration, logger):
+    """Reschedule the repeating job to the interval the last cycle's duration calls for"""
+    aps_job = getattr(job, 'job', None)
+    if aps_job is None:
+        return
+    interval = cycle_interval(duration)
+    if aps_job.trigger.interval.total_seconds() != interval:
+        logger.info("Cycle took {:.0f}s, polling every {}s".format(duration, interval))
+        aps_job.reschedule(trigger='interval', seconds=interval)
+
+
+def DeliverTweetsJob(context_in: CallbackContext) -> None:
+    bot = context_in.bot
+    logger = logging.getLogger(DeliverTweetsJob.__name__)
+
+    # at most DELIVERY_PER_CHAT rows per chat, so a chat subscribed to
+    # hundreds of accounts can't fill the whole batch
+    now = datetime.now()
+    ranked = (Outbox.select(Outbox.id, fn.ROW_NUMBER().over(
+                  partition_by=[Outbox.tg_chat], order_by=[Outbox.id]).alias('rank'))
+              .where(Outbox.next_attempt_at <= now))
+    entries = list(Outbox.select(Outbox, Tweet, TwitterUser, TelegramChat)
+                   .join(Tweet).join(TwitterUser)
+                   .switch(Outbox).join(TelegramChat)
+                   .switch(Outbox).join(ranked, on=(Outbox.id == ranked.c.id))
+                   .where(ranked.c.rank <= config.get('DELIVERY_PER_CHAT', 20),
+                          TelegramChat.delete_soon == False)
+                   .order_by(Outbox.id)
+                   .limit(config.get('DELIVERY_BATCH', 500)))
+    if not entries:
+        return
+    logger.debug("Delivering {} queued tweets".format(len(entries)))
+
+    # every tweet's media in one query instead of one per delivery
+    media = TweetMedia.by_tweet({entry.tweet.tw_id for entry in entries})
+
+    queues = OrderedDict()
+    for entry in entries:
+        queues.setdefault(entry.tg_chat_id, []).append(entry)
+
+    @closes_connection
+    def deliver_chat(queue):
+        """Send a chat's tweets in order, the first one that has to wait holds back the rest"""
+        for entry in queue:
+            try:
+                retry = bot.send_tweet(entry.tg_chat, entry.tweet, entry.sub_kind,
+                                       media=media.get(entry.tweet.tw_id, []),
+                                       text_sent=entry.text_sent)
+            except Exception:
+                # counted as a failed attempt
+                logger.exception("Delivering tweet {} to chat {} failed".format(
+                    entry.tweet.tw_id, entry.tg_chat.chat_id))
+                retry = Retry(None, entry.text_sent)
+            if retry is not None:
+                reschedule_delivery(entry, retry, logger)
+                return
+            # gone from the outbox as soon as it is sent, a restart resumes
+            # with the next one
+            with write_transaction():
+                Outbox.delete().where(Outbox.id == entry.id).execute()
+
+    # a task per chat: a slow chat only holds up its own tweets, and the
+    # DELIVERY_PER_CHAT cap keeps a busy chat from taking the whole run
+    with ThreadPoolExecutor(max_workers=config.get('DELIVERY_WORKERS', 4)) as pool:
+        list(pool.map(deliver_chat, queues.values()))
+
+
+def reschedule_delivery(entry, retry, logger):
+    """Back off a delivery that has to be tried again, with the chat's later tweets behind it"""
+    with write_transaction():
+        if retry.delay is not None:
+            # flood control isn't the delivery's fault, don't count it
+            delay = retry.delay
+        elif entry.attempts + 1 >= DELIVERY_MAX_ATTEMPTS:
+            logger.warning("Giving up on tweet {} for chat {}".format(
+                entry.tweet.tw_id, entry.tg_chat.chat_id))
+            entry.delete_instance()
+            return
+        else:
+            entry.attempts += 1
+            delay = DELIVERY_RETRY_DELAY * 2 ** entry.attempts
+
+        entry.text_sent = retry.text_sent
+        entry.next_attempt_at = datetime.now() + timedelta(seconds=delay)
+        entry.save()
+        # keep the chat's queue in order behind the rescheduled tweet
+        (Outbox.update(next_attempt_at=entry.next_attempt_at)
+         .where(Outbox.tg_chat == entry.tg_chat_id,
+                Outbox.id > entry.id,
+                Outbox.next_attempt_at < entry.next_attempt_at)
+         .execute())
+
+
+def RefreshTwitterUsersJob(context_in: CallbackContext) -> None:
+    """Keep the names and screen names of subscribed accounts up to date, a few batches per run"""
+    global _refresh_after
+    bot = context_in.bot
+    logger = logging.getLogger(RefreshTwitterUsersJob.__name__)
+
+    for _ in range(REFRESH_CALLS):
+        tw_users = list(TwitterUser
+                        .select(TwitterUser.id, TwitterUser.tw_id, TwitterUser.screen_name,
+                                TwitterUser.name)
+                        .where(TwitterUser.id > _refresh_after,
+                               TwitterUser.id << Subscription.select(Subscription.tw_user))
+                        .order_by(TwitterUser.id)
+                        .limit(REFRESH_CHUNK))
+        if not tw_users:
+            # went through all of them, start over next run
+            _refresh_after = 0
+            return
+
+        by_id = {u.tw_id: u for u in tw_users if u.tw_id}
+        by_name = {u.screen_name.lower(): u for u in tw_users if not u.tw_id}
+        try:
+            profiles = []
+            if by_id:
+                profiles.extend(lookup_users(bot.tw, user_id=list(by_id)))
+            if by_name:
+                profiles.extend(lookup_users(bot.tw, screen_name=list(by_name)))
+        except tweepy.errors.TweepyException as e:
+            logger.debug("Refreshing accounts stopped: {}".format(e))
+            return
+
+        for profile in profiles:
+            tw_user = by_id.get(profile.id) or by_name.get(profile.screen_name.lower())
+            if tw_user is None:
+                continue
+            if (tw_user.screen_name, tw_user.name, tw_user.tw_id) == \
+                    (profile.screen_name, profile.name, profile.id):
+                continue
+            logger.debug("Refreshing @{}, now @{} ({})".format(
+                tw_user.screen_name, profile.screen_name, profile.name))
+            bot.tw_users.pop(tw_user.screen_name.lower())
+            try:
+                TwitterUser.update(screen_name=profile.screen_name, name=profile.name,
+                                   tw_id=profile.id) \
+                    .where(TwitterUser.id == tw_user.id).execute()
+            except IntegrityError:
+                # another row took that screen name, keep both as they are
+                logger.info("Can't rename @{} to @{}, the name is taken".format(
+                    tw_user.screen_name, profile.screen_name))
+
+        _refresh_after = tw_users[-1].id
+
+
+def CompactTweetsJob(context_in: CallbackContext) -> None:
+    """
+    Delete the stored tweets every subscription of their account is past, and
+    give their space back to the filesystem. The tweet at each subscription's
+    last_tweet_id stays for /all, and queued tweets stay until delivered.
+    """
+    logger = logging.getLogger(CompactTweetsJob.__name__)
+    # created_at is stored as naive UTC
+    cutoff = datetime.utcnow() - timedelta(seconds=config.get('TWEET_RETENTION', TWEET_RETENTION))
+
+    # an account nobody subscribes to anymore keeps its latest tweet
+    passed = fn.COALESCE(Subscription.select(fn.MIN(Subscription.last_tweet_id))
+                         .where(Subscription.tw_user == Tweet.twitter_user),
+                         TwitterUser.last_tweet_id)
+    query = (Tweet.select(Tweet.id, Tweet.tw_id)
+             .join(TwitterUser)
+             .where(Tweet.created_at < cutoff,
+                    Tweet.tw_id < passed,
+                    Tweet.id.not_in(Outbox.select(Outbox.tweet)))
+             .order_by(Tweet.id)
+             .limit(COMPACT_CHUNK))
+
+    deleted = 0
+    last_id = 0
+    while True:
+        rows = list(query.where(Tweet.id > last_id).tuples())
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        # short transactions, the fetch and delivery jobs write meanwhile
+        with write_transaction():
+            TweetMedia.delete().where(TweetMedia.tweet << [tw_id for _, tw_id in rows]).execute()
+            deleted += Tweet.delete().where(Tweet.id << [pk for pk, _ in rows]).execute()
+
+    metrics.incr('tweets_compacted', deleted)
+    if deleted:
+        logger.info("Deleted {} tweets every subscription is past".format(deleted))
+
+    if isinstance(db.obj, SqliteDatabase):
+        compact_sqlite(logger)
+
+
+def compact_sqlite(logger):
+    """Give the pages deleted rows freed back to the filesystem"""
+    if db.execute_sql('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        # created before auto_vacuum=incremental, see migrations.enable_incremental_vacuum()
+        logger.debug("The database isn't set up for incremental vacuum, its free pages are reused")
+        return
+    freed = db.execute_sql('PRAGMA freelist_count').fetchone()[0]
+    if freed:
+        # the statement frees a page per step, and the sqlite3 module only
+        # steps it to the end through executescript
+        db.connection().executescript('PRAGMA incremental_vacuum')
+        logger.debug("Vacuumed {} free pages".format(freed))
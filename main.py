@@ -1,5 +1,6 @@
+import argparse
 import logging
-import math
+import time
 
 import tweepy
 from telegram.ext import CommandHandler
@@ -8,8 +9,12 @@ from telegram.ext.messagehandler import MessageHandler, Filters
 
 from bot import TwitterForwarderBot
 from commands import *
-from job import FetchAndSendTweetsJob
-from models import TwitterUser
+from job import (FetchAndSendTweetsJob, DeliverTweetsJob, RefreshTwitterUsersJob, HeartbeatJob,
+                 CompactTweetsJob, FETCH_JOB)
+from migrations import migrate_schema
+from models import JobState, init_db
+from scheduler import cycle_interval
+from sharding import ShardCoordinator, HEARTBEAT_INTERVAL
 
 try:
     from secrets import env
@@ -24,6 +29,14 @@ except ImportError:
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Forward tweets to Telegram chats.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--front', action='store_true',
+                      help="handle the bot's commands and deliver tweets, leaving the fetching "
+                           "to --worker processes")
+    mode.add_argument('--worker', action='store_true',
+                      help="only fetch tweets, sharing the accounts with the other workers")
+    args = parser.parse_args()
 
     logging.basicConfig(
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -31,6 +44,13 @@ if __name__ == '__main__':
 
     logging.getLogger(TwitterForwarderBot.__name__).setLevel(logging.INFO)
     logging.getLogger(FetchAndSendTweetsJob.__name__).setLevel(logging.INFO)
+    logging.getLogger(DeliverTweetsJob.__name__).setLevel(logging.INFO)
+    logging.getLogger(CompactTweetsJob.__name__).setLevel(logging.INFO)
+    logging.getLogger('migrations').setLevel(logging.INFO)
+    logging.getLogger('sharding').setLevel(logging.INFO)
+
+    init_db()
+    migrate_schema()
 
     # initialize Twitter API
     try:
@@ -55,7 +75,20 @@ if __name__ == '__main__':
             print(("The optional configuration variable {} is missing. "
                    "Tweepy will be initialized in 'app-only' mode.").format(var))
 
-    twapi = tweepy.API(auth, wait_on_rate_limit=True)
+    if env.get('POLL_MODE', 'timeline') == 'lists':
+        # lists are owned by, and can only be read with, a user context
+        try:
+            auth = tweepy.OAuthHandler(env['TWITTER_CONSUMER_KEY'], env['TWITTER_CONSUMER_SECRET'])
+            auth.set_access_token(env['TWITTER_ACCESS_TOKEN'], env['TWITTER_ACCESS_TOKEN_SECRET'])
+        except KeyError as exc:
+            var = exc.args[0]
+            print(("The configuration variable {} is required with POLL_MODE='lists'. "
+                   "Please review secrets.py.").format(var))
+            exit(123)
+
+    # rate limits are tracked from the response headers (see credentials.py)
+    # instead of sleeping in the job thread
+    twapi = tweepy.API(auth)
 
     # initialize telegram API
     token = env['TELEGRAM_BOT_TOKEN']
@@ -84,23 +117,41 @@ if __name__ == '__main__':
     dispatcher.add_handler(CommandHandler('set_timezone', cmd_set_timezone, pass_args=True))
     dispatcher.add_handler(MessageHandler(Filters.text, handle_chat))
 
-    # Twitter API rate limit parameters
-    LIMIT_WINDOW = 15 * 60
-    LIMIT_COUNT = 900
-    MIN_INTERVAL = 30
-    TWEET_BATCH_INSERT_COUNT = 100
-    tw_count = (TwitterUser.select()
-                .join(Subscription)
-                .group_by(TwitterUser)
-                .count())
-    res = math.ceil(tw_count * LIMIT_WINDOW / LIMIT_COUNT)
-    res_max = max(MIN_INTERVAL, res)
-
     # put job
     queue = updater.job_queue
     #queue.put(FetchAndSendTweetsJob(), next_t=0)
     #queue.run_once(FetchAndSendTweetsJob, 2)
-    queue.run_repeating(FetchAndSendTweetsJob, interval=res_max, first=1)
+    if args.worker:
+        # the accounts are split in shards, leased between the live workers
+        bot.shards = ShardCoordinator()
+        bot.shards.heartbeat()
+        queue.run_repeating(HeartbeatJob,
+                            interval=env.get('HEARTBEAT_INTERVAL', HEARTBEAT_INTERVAL), first=1)
+    if not args.front:
+        # the scheduler spreads the rate-limit budget over the cycles itself, and
+        # the interval is stretched while cycles take longer than it
+        fetch_job = FETCH_JOB if bot.shards is None else '{}:{}'.format(FETCH_JOB, bot.shards.name)
+        queue.run_repeating(FetchAndSendTweetsJob,
+                            interval=cycle_interval(JobState.load(fetch_job).duration), first=1)
+    if not args.worker:
+        queue.run_repeating(DeliverTweetsJob, interval=env.get('DELIVERY_INTERVAL', 5), first=1)
+        queue.run_repeating(RefreshTwitterUsersJob,
+                            interval=env.get('REFRESH_INTERVAL', 15 * 60), first=60)
+        queue.run_repeating(CompactTweetsJob,
+                            interval=env.get('COMPACT_INTERVAL', 60 * 60), first=5 * 60)
+
+    if args.worker:
+        # no Telegram updates to poll, only the jobs run
+        queue.start()
+        try:
+            while True:
+                time.sleep(1)
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            queue.stop()
+            bot.shards.leave()
+        exit(0)
 
     # poll
     updater.start_polling()
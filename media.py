@@ -0,0 +1,115 @@
+"""
+On-disk cache of tweet media, for when Telegram can't fetch a url itself.
+
+Items are streamed to disk once and kept in a size-capped LRU directory, so a
+tweet fanned out to many chats is downloaded a single time. Concurrent
+requests for the same url wait for the one download in progress.
+"""
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+from urllib.parse import urlparse
+
+import requests
+
+DOWNLOAD_TIMEOUT = 30
+CHUNK_SIZE = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class MediaCache(object):
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        # path -> size, least recently used first
+        self._entries = OrderedDict()
+        self._size = 0
+        # url -> Future of the download in progress
+        self._downloads = {}
+
+        os.makedirs(directory, exist_ok=True)
+        files = [os.path.join(directory, name) for name in os.listdir(directory)]
+        for path in sorted(files, key=os.path.getatime):
+            if path.endswith('.part'):
+                os.remove(path)
+                continue
+            self._entries[path] = os.path.getsize(path)
+            self._size += self._entries[path]
+        self._evict()
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def path_for(self, url):
+        _, ext = os.path.splitext(urlparse(url).path)
+        return os.path.join(self.directory, hashlib.sha1(url.encode()).hexdigest() + ext)
+
+    def get(self, url):
+        """The local path of the url's content, downloaded if it isn't cached"""
+        path = self.path_for(url)
+        with self._lock:
+            if path in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(path)
+                return path
+            self.misses += 1
+            future = self._downloads.get(url)
+            owner = future is None
+            if owner:
+                future = self._downloads[url] = Future()
+
+        if not owner:
+            return future.result()
+
+        try:
+            size = self._download(url, path)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            with self._lock:
+                self._entries[path] = size
+                self._size += size
+                self._evict()
+            future.set_result(path)
+            return path
+        finally:
+            with self._lock:
+                self._downloads.pop(url, None)
+
+    def _download(self, url, path):
+        logger.debug("Downloading {}".format(url))
+        part = path + '.part'
+        size = 0
+        try:
+            with requests.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as resp:
+                resp.raise_for_status()
+                with open(part, 'wb') as f:
+                    for chunk in resp.iter_content(CHUNK_SIZE):
+                        f.write(chunk)
+                        size += len(chunk)
+            os.replace(part, path)
+        except Exception:
+            if os.path.exists(part):
+                os.remove(part)
+            raise
+        return size
+
+    def _evict(self):
+        # keeps the newest entry even if it alone is over the cap
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            path, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,182 @@
+"""
+Versioned schema migrations.
+
+The schemaversion table records the last migration applied. Startup runs the
+migrations after it in order, or nothing at all when the schema is current.
+A new database gets every table and index straight from the models and
+starts at the latest version. Each migration checks what is there before
+changing it, so one that was interrupted can simply run again.
+"""
+import ast
+import datetime
+import logging
+
+import config
+
+from peewee import IntegerField, DateTimeField, SqliteDatabase, fn
+from playhouse.migrate import migrate, SchemaMigrator
+
+from models import (db, write_transaction, BaseModel, TwitterList, TwitterUser, TelegramChat,
+                    Tweet, TweetMedia, Subscription, Outbox, JobState, Worker, ShardLease)
+
+logger = logging.getLogger(__name__)
+
+MODELS = (TwitterList, TwitterUser, TelegramChat, Tweet, TweetMedia, Subscription, Outbox, JobState,
+          Worker, ShardLease)
+
+
+class SchemaVersion(BaseModel):
+    version = IntegerField()
+    applied_at = DateTimeField(default=datetime.datetime.now)
+
+
+def add_missing_columns(table, fields):
+    """Add the fields whose column the table doesn't have yet, with their indexes"""
+    migrator = SchemaMigrator.from_database(db.obj)
+    existing = {c.name for c in db.get_columns(table)}
+    added = []
+    for field in fields:
+        if field.column_name not in existing:
+            migrate(migrator.add_column(table, field.column_name, field))
+            added.append(field.column_name)
+    return added
+
+
+def create_missing_tables(models):
+    # only tables that don't exist: on an existing table create_table would also
+    # index columns that only later migrations add
+    for model in models:
+        if not model.table_exists():
+            model.create_table()
+
+
+def migration_1():
+    """The columns and tables added before migrations were versioned"""
+    create_missing_tables((TwitterList, TwitterUser, TelegramChat, Tweet, Subscription, Outbox,
+                           JobState))
+    add_missing_columns('tweet', [Tweet.photo_url, Tweet.video_url])
+    add_missing_columns('twitteruser', [TwitterUser.last_fetched, TwitterUser.tw_id,
+                                        TwitterUser.twitter_list, TwitterUser.tweet_rate,
+                                        TwitterUser.next_poll_at])
+    add_missing_columns('telegramchat', [TelegramChat.twitter_request_token,
+                                         TelegramChat.twitter_token, TelegramChat.twitter_secret,
+                                         TelegramChat.timezone_name, TelegramChat.delete_soon,
+                                         TelegramChat.home_last_tweet_id,
+                                         TelegramChat.home_polled_at])
+    add_missing_columns('outbox', [Outbox.text_sent])
+    add_missing_columns('twitterlist', [TwitterList.polled_at])
+
+    if add_missing_columns('twitteruser', [TwitterUser.last_tweet_id]):
+        # backfill the high-water mark from the tweets stored so far
+        db.execute_sql(
+            'UPDATE twitteruser SET last_tweet_id = COALESCE('
+            '(SELECT MAX(tw_id) FROM tweet WHERE tweet.twitter_user_id = twitteruser.id), 0)')
+
+
+def migration_2():
+    """Move the media of tweets stored before TweetMedia out of photo_url/video_url"""
+    if TweetMedia.table_exists():
+        return
+    TweetMedia.create_table()
+
+    query = (Tweet.select(Tweet.tw_id, Tweet.photo_url, Tweet.video_url)
+             .where(((Tweet.photo_url != '') & (Tweet.photo_url != '[]')) |
+                    (Tweet.video_url != ''))
+             .tuples())
+    rows = []
+    for tw_id, photo_url, video_url in query.iterator():
+        try:
+            # literal_eval only accepts literals, unlike the eval() this replaces
+            photos = ast.literal_eval(photo_url) if photo_url else []
+        except (ValueError, SyntaxError):
+            photos = []
+        for position, url in enumerate(photos):
+            rows.append({'tweet': tw_id, 'position': position, 'kind': 'photo', 'url': url,
+                         'bitrate': None, 'width': None, 'height': None})
+        if video_url:
+            rows.append({'tweet': tw_id, 'position': 0, 'kind': 'video', 'url': video_url,
+                         'bitrate': None, 'width': None, 'height': None})
+
+    for i in range(0, len(rows), 100):
+        TweetMedia.insert_many(rows[i:i + 100]).execute()
+    Tweet.update(photo_url='', video_url='').execute()
+
+
+def migration_3():
+    """The indexes of the job's queries: tweets by user, subscription pairs, chats to delete"""
+    # a chat could end up subscribed twice to an account, keep the oldest row
+    # before the pair becomes unique
+    keep = Subscription.select(fn.MIN(Subscription.id)).group_by(Subscription.tg_chat,
+                                                                 Subscription.tw_user)
+    removed = Subscription.delete().where(Subscription.id.not_in(keep)).execute()
+    if removed:
+        logger.info("Removed {} duplicated subscriptions".format(removed))
+
+    # the models as of this version, later tables are created by their own migration
+    for model in (TwitterList, TwitterUser, TelegramChat, Tweet, TweetMedia, Subscription, Outbox,
+                  JobState):
+        model._schema.create_indexes(safe=True)
+
+
+def migration_4():
+    """Unique media per tweet, so inserts racing another process can ignore conflicts"""
+    keep = TweetMedia.select(fn.MIN(TweetMedia.id)).group_by(TweetMedia.tweet, TweetMedia.kind,
+                                                             TweetMedia.position)
+    TweetMedia.delete().where(TweetMedia.id.not_in(keep)).execute()
+    TweetMedia._schema.create_indexes(safe=True)
+
+
+def migration_5():
+    """The tables fetch workers coordinate through"""
+    create_missing_tables((Worker, ShardLease))
+
+
+def migration_6():
+    add_missing_columns('twitteruser', [TwitterUser.list_gap])
+
+
+MIGRATIONS = [migration_1, migration_2, migration_3, migration_4, migration_5, migration_6]
+
+
+def enable_incremental_vacuum():
+    """
+    Switch a SQLite database created before auto_vacuum=incremental, so
+    CompactTweetsJob can give freed pages back. That takes one full VACUUM:
+    it rewrites the whole file, needs as much free disk space again, and
+    locks the database until done. So it only runs at startup, and only
+    with SQLITE_INCREMENTAL_VACUUM=True.
+    """
+    if not isinstance(db.obj, SqliteDatabase) or not config.get('SQLITE_INCREMENTAL_VACUUM', False):
+        return
+    if db.execute_sql('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        return
+    logger.info("Rebuilding the database for incremental vacuum, this may take a while")
+    db.execute_sql('PRAGMA auto_vacuum = INCREMENTAL')
+    db.execute_sql('VACUUM')
+
+
+def schema_version():
+    return SchemaVersion.select(fn.MAX(SchemaVersion.version)).scalar() or 0
+
+
+def migrate_schema():
+    """Bring the database up to the latest schema version"""
+    create_missing_tables([SchemaVersion])
+    latest = len(MIGRATIONS)
+
+    if not Tweet.table_exists():
+        # a new database
+        with write_transaction():
+            create_missing_tables(MODELS)
+            SchemaVersion.create(version=latest)
+        return
+
+    current = schema_version()
+    for version in range(current + 1, latest + 1):
+        logger.info("Migrating the database to version {}".format(version))
+        with write_transaction():
+            MIGRATIONS[version - 1]()
+            SchemaVersion.create(version=version)
+
+    # outside the versioned migrations, VACUUM can't run in a transaction
+    enable_incremental_vacuum()
@@ -0,0 +1,99 @@
+import time
+from threading import Lock
+
+# Twitter API rate limit parameters
+LIMIT_WINDOW = 15 * 60
+LIMIT_COUNT = 900
+
+
+class TokenBucket(object):
+    """
+    `rate` tokens per second, bursting up to `capacity`. Taking more than the
+    capacity runs into debt that later takes wait out. Not thread-safe on its own
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now, tokens=1):
+        self._refill(now)
+        needed = min(tokens, self.capacity)
+        if self.tokens >= needed:
+            return 0
+        return (needed - self.tokens) / self.rate
+
+    def take(self, tokens=1):
+        self.tokens -= tokens
+
+
+class TelegramRateLimiter(object):
+    """
+    Keeps the bot under Telegram's flood limits: about 30 messages per second
+    overall, 1 per second in a chat and 20 per minute in a group. Chats that got
+    a RetryAfter are held back until it expires.
+    """
+
+    GLOBAL_RATE = 30
+    CHAT_RATE = 1
+    GROUP_RATE = 20 / 60
+    GROUP_BURST = 20
+
+    def __init__(self):
+        self._lock = Lock()
+        self._global = TokenBucket(self.GLOBAL_RATE, self.GLOBAL_RATE)
+        self._chats = {}
+        self._groups = {}
+        self._blocked_until = {}
+
+    def _buckets(self, chat_id):
+        buckets = [self._global]
+        if chat_id not in self._chats:
+            self._chats[chat_id] = TokenBucket(self.CHAT_RATE, 1)
+        buckets.append(self._chats[chat_id])
+        if is_group_chat(chat_id):
+            if chat_id not in self._groups:
+                self._groups[chat_id] = TokenBucket(self.GROUP_RATE, self.GROUP_BURST)
+            buckets.append(self._groups[chat_id])
+        return buckets
+
+    def acquire(self, chat_id, max_wait=None, tokens=1):
+        """
+        Wait until `tokens` messages may be sent to the chat and take them.
+        Telegram counts every item of a media group as a message.
+
+        Returns 0 once sending is allowed, or, without taking anything, the number
+        of seconds still to wait when that is more than max_wait.
+        """
+        while True:
+            with self._lock:
+                buckets = self._buckets(chat_id)
+                now = time.monotonic()
+                wait = max([self._blocked_until.get(chat_id, 0) - now] +
+                           [b.wait_time(now, tokens) for b in buckets])
+                if wait <= 0:
+                    for b in buckets:
+                        b.take(tokens)
+                    return 0
+            if max_wait is not None and wait > max_wait:
+                return wait
+            time.sleep(wait)
+
+    def retry_after(self, chat_id, seconds):
+        with self._lock:
+            until = time.monotonic() + seconds
+            self._blocked_until[chat_id] = max(self._blocked_until.get(chat_id, 0), until)
+
+
+def is_group_chat(chat_id):
+    try:
+        return int(chat_id) < 0
+    except ValueError:
+        # channel usernames, Telegram treats them like groups
+        return True
@@ -0,0 +1,114 @@
+"""
+Adaptive per-account polling.
+
+Every TwitterUser has a next_poll_at, and the indexed column is the priority
+queue: each cycle polls the most overdue accounts the rate-limit budget allows,
+and spends what is left on the accounts due next.
+After a poll the account's tweet rate is updated and its next poll is planned
+about when its next tweet is expected, so busy accounts are polled often and
+quiet ones rarely. New subscriptions start out due right away.
+"""
+import math
+from datetime import timedelta
+
+from peewee import fn, SQL
+
+import config
+from models import TwitterUser, Subscription
+from ratelimit import LIMIT_COUNT, LIMIT_WINDOW
+from sharding import shard_of
+
+MIN_INTERVAL = 30
+MIN_POLL_INTERVAL = 60
+MAX_POLL_INTERVAL = 60 * 60
+RATE_SMOOTHING = 0.3
+DUE_PAGE = 500
+# an overrunning cycle is followed by this much of its duration before the next
+OVERRUN_MARGIN = 1.2
+
+# what polling an account and planning its next poll read
+POLL_COLUMNS = (TwitterUser.id, TwitterUser.screen_name, TwitterUser.tw_id,
+                TwitterUser.last_tweet_id, TwitterUser.last_fetched, TwitterUser.tweet_rate,
+                TwitterUser.next_poll_at)
+
+
+def poll_interval():
+    """Seconds between two fetch cycles"""
+    return max(MIN_INTERVAL, config.get('POLL_INTERVAL', MIN_INTERVAL))
+
+
+def cycle_interval(last_duration=0):
+    """Seconds between fetch cycles, stretched past poll_interval() while cycles overrun it"""
+    return max(poll_interval(), math.ceil(last_duration * OVERRUN_MARGIN))
+
+
+def cycle_budget(tokens=1, interval=None):
+    """user_timeline calls one cycle may spend to stay under the rate limits of `tokens` tokens"""
+    interval = interval or poll_interval()
+    return max(1, math.floor(LIMIT_COUNT * tokens * interval / LIMIT_WINDOW))
+
+
+def due_query(unlisted_only=False, shards=None):
+    """The first page of due_users()"""
+    # EXISTS lets the database walk the next_poll_at index in order and stop
+    # at the LIMIT, an IN list would have it sort every subscribed account
+    subscribed = Subscription.select(SQL('1')).where(Subscription.tw_user == TwitterUser.id)
+    query = (TwitterUser.select(*POLL_COLUMNS)
+             .where(fn.EXISTS(subscribed))
+             .order_by(TwitterUser.next_poll_at, TwitterUser.id)
+             .limit(DUE_PAGE))
+    if unlisted_only:
+        # accounts in a list only need a call of their own for their first
+        # tweet, or to catch up with tweets a list poll missed
+        query = query.where(TwitterUser.twitter_list.is_null(True) |
+                            (TwitterUser.last_tweet_id == 0) |
+                            (TwitterUser.list_gap == True))
+    if shards is not None:
+        query = query.where(shard_of(TwitterUser.id) << list(shards))
+    return query
+
+
+def due_users(limit, skip=(), unlisted_only=False, shards=None):
+    """
+    The subscribed accounts to poll, most overdue first. Budget left over
+    once every due account is in goes to the accounts due next, so spare calls
+    lower the latency instead of going unused. They are read
+    DUE_PAGE at a time with only the columns a poll needs, so a cycle's
+    memory doesn't grow with the number of accounts. With `shards`, only the
+    accounts in those shards.
+    """
+    query = due_query(unlisted_only, shards)
+    tw_users = []
+    page = query
+    while True:
+        last = None
+        for tw_user in page.iterator():
+            last = tw_user
+            if tw_user.id in skip:
+                continue
+            tw_users.append(tw_user)
+            if len(tw_users) >= limit:
+                return tw_users
+        if last is None:
+            return tw_users
+        # keyset pagination: continue after the last (next_poll_at, id) seen
+        page = query.where((TwitterUser.next_poll_at > last.next_poll_at) |
+                           ((TwitterUser.next_poll_at == last.next_poll_at) &
+                            (TwitterUser.id > last.id)))
+
+
+def plan_next_poll(tw_user, new_tweets, now):
+    """Update the account's tweet rate with a poll's result, returns (rate, next_poll_at)"""
+    rate = tw_user.tweet_rate
+    if not tw_user.last_tweet_id and new_tweets:
+        # that was the first poll, it only fetched the latest tweet
+        return rate, now + timedelta(seconds=MIN_POLL_INTERVAL)
+
+    # tweets per hour since the previous poll, smoothed over the last polls
+    hours = max((now - tw_user.last_fetched).total_seconds() / 3600, 1 / 60)
+    rate = RATE_SMOOTHING * (new_tweets / hours) + (1 - RATE_SMOOTHING) * rate
+
+    max_interval = config.get('MAX_POLL_INTERVAL', MAX_POLL_INTERVAL)
+    interval = 3600 / rate if rate > 0 else max_interval
+    interval = min(max(interval, MIN_POLL_INTERVAL), max_interval)
+    return rate, now + timedelta(seconds=interval)
@@ -0,0 +1,108 @@
+"""
+Splits the fetch work between worker processes.
+
+Every account belongs to one of SHARDS shards by its id. Worker processes
+heartbeat into the database and lease an even share of the shards: a worker
+holding more than its share gives the rest back, and a worker with less takes
+shards that are free or whose lease expired. Workers joining or dying
+(their heartbeat and leases run out after LEASE_TTL) rebalance the shards
+within a few heartbeats.
+"""
+import logging
+import math
+import os
+import socket
+from datetime import datetime, timedelta
+from threading import Lock
+
+import config
+from models import Worker, ShardLease, write_transaction
+
+SHARDS = 64
+LEASE_TTL = 120
+HEARTBEAT_INTERVAL = 30
+
+logger = logging.getLogger(__name__)
+
+
+def shard_of(id_expression):
+    """The shard of an id column, as a query expression"""
+    shards = config.get('SHARDS', SHARDS)
+    # id % shards, spelled out: psycopg2 would take a bare % for a placeholder
+    return id_expression - (id_expression / shards) * shards
+
+
+class ShardCoordinator(object):
+    def __init__(self, name=None):
+        self.name = (name or config.get('WORKER_NAME')
+                     or "{}-{}".format(socket.gethostname(), os.getpid()))
+        self.shards = config.get('SHARDS', SHARDS)
+        self.ttl = timedelta(seconds=config.get('LEASE_TTL', LEASE_TTL))
+        self.workers = 1
+        self._owned = frozenset()
+        self._lock = Lock()
+        ShardLease.insert_many([{'shard': shard} for shard in range(self.shards)]) \
+            .on_conflict_ignore().execute()
+
+    @property
+    def owned(self):
+        """The shards this worker holds a lease on"""
+        with self._lock:
+            return self._owned
+
+    def shard(self, pk):
+        return pk % self.shards
+
+    def heartbeat(self):
+        """Renew this worker's leases and move it towards its fair share of the shards"""
+        now = datetime.now()
+        expires = now + self.ttl
+        mine = ShardLease.owner == self.name
+        available = ShardLease.owner.is_null(True) | (ShardLease.expires_at < now)
+
+        with write_transaction():
+            (Worker.insert(name=self.name, heartbeat_at=now)
+             .on_conflict(conflict_target=[Worker.name], preserve=[Worker.heartbeat_at])
+             .execute())
+            workers = Worker.select().where(Worker.heartbeat_at > now - self.ttl).count()
+            share = math.ceil(self.shards / max(workers, 1))
+
+            ShardLease.update(expires_at=expires).where(mine).execute()
+            owned = [shard for (shard,) in ShardLease.select(ShardLease.shard)
+                     .where(mine, ShardLease.shard < self.shards)
+                     .order_by(ShardLease.shard).tuples()]
+
+            if len(owned) > share:
+                # give the rest back for the workers that joined
+                ShardLease.update(owner=None, expires_at=now) \
+                    .where(mine, ShardLease.shard << owned[share:]).execute()
+                owned = owned[:share]
+
+            if len(owned) < share:
+                free = [shard for (shard,) in ShardLease.select(ShardLease.shard)
+                        .where(available, ShardLease.shard < self.shards)
+                        .order_by(ShardLease.shard)
+                        .limit(share - len(owned)).tuples()]
+                for shard in free:
+                    # only if nobody took it in the meantime
+                    taken = ShardLease.update(owner=self.name, expires_at=expires) \
+                        .where(ShardLease.shard == shard, available).execute()
+                    if taken:
+                        owned.append(shard)
+
+        if set(owned) != self.owned:
+            logger.info("Worker {} now fetches {} of {} shards, {} workers alive".format(
+                self.name, len(owned), self.shards, workers))
+        with self._lock:
+            self._owned = frozenset(owned)
+            self.workers = workers
+        return self.owned
+
+    def leave(self):
+        """Hand the shards back right away, for a clean shutdown"""
+        with write_transaction():
+            ShardLease.update(owner=None, expires_at=datetime.now()) \
+                .where(ShardLease.owner == self.name).execute()
+            Worker.delete().where(Worker.name == self.name).execute()
+        with self._lock:
+            self._owned = frozenset()
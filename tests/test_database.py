@@ -0,0 +1,114 @@
+"""
+Database behaviour across backends. The PostgreSQL tests run against the
+database in the DATABASE_URL environment variable, e.g.
+DATABASE_URL=postgres://forwarder@localhost/forwarder_test python -m pytest
+and drop and recreate its tables.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pytest
+from playhouse.pool import PooledSqliteDatabase
+
+import config
+import migrations
+from job import queue_new_tweets, CompactTweetsJob
+from models import (db, init_db, closes_connection, Tweet, TweetMedia, TwitterUser, TelegramChat,
+                    Subscription, Outbox)
+from scheduler import due_users
+from sharding import ShardCoordinator
+
+DATABASE_URL = os.environ.get('DATABASE_URL')
+
+
+def test_pool_threads_give_connections_back(tmp_path):
+    db.initialize(PooledSqliteDatabase(str(tmp_path / 'test.db'), max_connections=2,
+                                       check_same_thread=False))
+    try:
+        migrations.migrate_schema()
+        db.close()
+        count = closes_connection(lambda: TelegramChat.select().count())
+        # a new pool every cycle, like the fetch and delivery jobs
+        for _ in range(5):
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                assert list(pool.map(lambda _: count(), range(4))) == [0] * 4
+    finally:
+        db.close_all()
+
+
+@pytest.fixture
+def postgres(monkeypatch):
+    if not DATABASE_URL:
+        pytest.skip("DATABASE_URL isn't set")
+    monkeypatch.setitem(config.env, 'DATABASE_URL', DATABASE_URL)
+    init_db()
+    db.drop_tables(list(migrations.MODELS) + [migrations.SchemaVersion], safe=True)
+    migrations.migrate_schema()
+    yield db
+    db.close()
+
+
+def subscribe(screen_name, chat_id, last_tweet_id=0):
+    tw_user = TwitterUser.create(screen_name=screen_name, name=screen_name)
+    chat, _ = TelegramChat.get_or_create(chat_id=chat_id, tg_type='private')
+    Subscription.create(tg_chat=chat, tw_user=tw_user, last_tweet_id=last_tweet_id)
+    return tw_user
+
+
+def tweet_row(tw_id, tw_user, media=()):
+    return {'tw_id': tw_id, 'text': 'tweet {}'.format(tw_id), 'created_at': datetime(2021, 1, 1),
+            'twitter_user': tw_user,
+            'media': [{'tweet': tw_id, 'position': i, 'kind': 'photo', 'url': url,
+                       'bitrate': None, 'width': None, 'height': None}
+                      for i, url in enumerate(media)]}
+
+
+def test_postgres_migrations(postgres):
+    assert migrations.schema_version() == len(migrations.MIGRATIONS)
+    migrations.migrate_schema()
+    assert migrations.schema_version() == len(migrations.MIGRATIONS)
+    # supergroup ids don't fit 32 bits
+    chat = TelegramChat.create(chat_id=-1001234567890, tg_type='supergroup')
+    assert TelegramChat.get_by_id(chat.id).chat_id == -1001234567890
+
+
+def test_postgres_ingest_and_fanout(postgres):
+    alice = subscribe('alice', 1)
+    rows = [tweet_row(10, alice, ['https://a/1.jpg']), tweet_row(11, alice)]
+    assert Tweet.insert_batch(rows) == 0
+    assert Tweet.insert_batch([tweet_row(11, alice), tweet_row(12, alice)]) == 1
+    assert TwitterUser.get_by_id(alice.id).last_tweet_id == 12
+    assert [m.url for m in TweetMedia.by_tweet([10])[10]] == ['https://a/1.jpg']
+
+    # a new subscription only gets the newest tweet, then the ones after it
+    queue_new_tweets([alice.id])
+    assert [o.tweet.tw_id for o in Outbox.select()] == [12]
+    Tweet.insert_batch([tweet_row(13, alice)])
+    queue_new_tweets([alice.id])
+    assert sorted(o.tweet.tw_id for o in Outbox.select()) == [12, 13]
+    assert Subscription.get().last_tweet_id == 13
+
+
+def test_postgres_sharding(postgres):
+    tw_users = [subscribe('user{}'.format(i), i) for i in range(10)]
+    first, second = ShardCoordinator('first'), ShardCoordinator('second')
+    first.heartbeat()
+    second.heartbeat()
+    first.heartbeat()
+    second.heartbeat()
+    assert first.owned and second.owned and not first.owned & second.owned
+
+    polled = due_users(100, shards=first.owned) + due_users(100, shards=second.owned)
+    assert sorted(u.id for u in polled) == sorted(u.id for u in tw_users)
+    assert all(first.shard(u.id) in first.owned for u in due_users(100, shards=first.owned))
+
+
+def test_postgres_compaction(postgres):
+    alice = subscribe('alice', 1, last_tweet_id=12)
+    Tweet.insert_batch([tweet_row(tw_id, alice, ['https://a/{}.jpg'.format(tw_id)])
+                        for tw_id in (10, 11, 12)])
+    CompactTweetsJob(None)
+    # the tweet at the subscription's last_tweet_id stays for /all
+    assert [t.tw_id for t in Tweet.select().order_by(Tweet.tw_id)] == [12]
+    assert TweetMedia.select().count() == 1
@@ -0,0 +1,102 @@
+"""DeliverTweetsJob: per-chat order, slow chats and retries"""
+import threading
+import time
+import types
+from datetime import datetime
+
+import pytest
+
+import migrations
+from bot import Retry
+from job import DeliverTweetsJob
+from models import db, init_db, Outbox, Tweet, TwitterUser, TelegramChat
+
+
+class FakeBot(object):
+    def __init__(self, send=None):
+        self.sent = []
+        self._send = send
+        self._lock = threading.Lock()
+
+    def send_tweet(self, chat, tweet, sub_kind, media=None, text_sent=False):
+        retry = self._send(chat.chat_id, tweet.tw_id) if self._send else None
+        if retry is None:
+            with self._lock:
+                self.sent.append((chat.chat_id, tweet.tw_id))
+        return retry
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    init_db(str(tmp_path / 'test.db'))
+    migrations.migrate_schema()
+    tw_user = TwitterUser.create(screen_name='alice', name='Alice')
+
+    def queue(chat_id, *tw_ids):
+        chat, _ = TelegramChat.get_or_create(chat_id=chat_id, tg_type='private')
+        for tw_id in tw_ids:
+            tweet = Tweet.create(tw_id=tw_id, text='tweet', created_at=datetime(2021, 1, 1),
+                                 twitter_user=tw_user)
+            Outbox.create(tg_chat=chat, tweet=tweet)
+
+    yield queue
+    db.close()
+
+
+def deliver(bot):
+    DeliverTweetsJob(types.SimpleNamespace(bot=bot, job=None))
+
+
+def test_chats_get_their_tweets_in_order(outbox):
+    outbox(1, 10, 11, 12)
+    outbox(2, 20, 21)
+    bot = FakeBot()
+    deliver(bot)
+    assert [tw_id for chat_id, tw_id in bot.sent if chat_id == 1] == [10, 11, 12]
+    assert [tw_id for chat_id, tw_id in bot.sent if chat_id == 2] == [20, 21]
+    assert Outbox.select().count() == 0
+
+
+def test_slow_chat_does_not_hold_up_others(outbox):
+    outbox(1, 10, 11)
+    outbox(2, 20, 21, 22)
+    done = {}
+
+    def send(chat_id, tw_id):
+        if tw_id == 10:
+            time.sleep(0.5)
+        done[tw_id] = time.monotonic()
+
+    deliver(FakeBot(send))
+    assert done[22] < done[10]
+
+
+def test_retry_holds_back_later_tweets(outbox):
+    outbox(1, 10, 11, 12)
+    outbox(2, 20)
+    bot = FakeBot(lambda chat_id, tw_id: Retry(None, False) if tw_id == 11 else None)
+    deliver(bot)
+
+    assert sorted(bot.sent) == [(1, 10), (2, 20)]
+    left = {o.tweet.tw_id: o for o in Outbox.select().join(Tweet)}
+    assert sorted(left) == [11, 12]
+    assert left[11].attempts == 1
+    assert left[11].next_attempt_at > datetime.now()
+    assert left[12].next_attempt_at >= left[11].next_attempt_at
+
+    # nothing is due until the retry
+    deliver(bot)
+    assert sorted(bot.sent) == [(1, 10), (2, 20)]
+
+
+def test_sent_tweets_leave_the_outbox_right_away(outbox):
+    outbox(1, 10, 11, 12)
+
+    def send(chat_id, tw_id):
+        if tw_id == 12:
+            # as if the process died here
+            raise SystemExit()
+
+    with pytest.raises(SystemExit):
+        deliver(FakeBot(send))
+    assert [o.tweet.tw_id for o in Outbox.select().join(Tweet)] == [12]
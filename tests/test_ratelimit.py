@@ -0,0 +1,18 @@
+"""TelegramRateLimiter: media groups take a token per item"""
+from ratelimit import TelegramRateLimiter
+
+
+def test_media_group_takes_a_token_per_item():
+    limiter = TelegramRateLimiter()
+    assert limiter.acquire(1, max_wait=0, tokens=4) == 0
+    # 1 message per second in a chat: the 3 extra items are paid off first
+    assert limiter.acquire(1, max_wait=0) > 3
+
+
+def test_group_burst_counts_items():
+    limiter = TelegramRateLimiter()
+    assert limiter.acquire(-1, max_wait=0, tokens=10) == 0
+    assert limiter.acquire(-2, max_wait=0, tokens=10) == 0
+    # the global bucket has 10 of its 30 left
+    assert limiter.acquire(-3, max_wait=0, tokens=10) == 0
+    assert limiter.acquire(-4, max_wait=0) > 0
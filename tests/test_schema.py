@@ -0,0 +1,104 @@
+"""Migrations, and the indexes the job's queries rely on, on SQLite"""
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+import migrations
+from job import pending_deliveries
+from models import db, init_db, Tweet, TweetMedia, TwitterUser, TelegramChat, Subscription
+from scheduler import due_query
+
+# the schema before migrations were versioned
+BASELINE_SCHEMA = '''
+CREATE TABLE "twitteruser" ("id" INTEGER NOT NULL PRIMARY KEY, "screen_name" VARCHAR(255) NOT NULL,
+    "known_at" DATETIME NOT NULL, "name" VARCHAR(255) NOT NULL, "last_fetched" DATETIME NOT NULL);
+CREATE UNIQUE INDEX "twitteruser_screen_name" ON "twitteruser" ("screen_name");
+CREATE TABLE "telegramchat" ("id" INTEGER NOT NULL PRIMARY KEY, "chat_id" INTEGER NOT NULL,
+    "known_at" DATETIME NOT NULL, "tg_type" VARCHAR(255) NOT NULL, "last_contact" DATETIME NOT NULL,
+    "twitter_request_token" VARCHAR(255), "twitter_token" VARCHAR(255),
+    "twitter_secret" VARCHAR(255), "timezone_name" VARCHAR(255), "delete_soon" INTEGER NOT NULL);
+CREATE UNIQUE INDEX "telegramchat_chat_id" ON "telegramchat" ("chat_id");
+CREATE TABLE "tweet" ("id" INTEGER NOT NULL PRIMARY KEY, "tw_id" INTEGER NOT NULL,
+    "known_at" DATETIME NOT NULL, "text" TEXT NOT NULL, "created_at" DATETIME NOT NULL,
+    "twitter_user_id" INTEGER NOT NULL,
+    "photo_url" TEXT NOT NULL, "video_url" TEXT NOT NULL,
+    FOREIGN KEY ("twitter_user_id") REFERENCES "twitteruser" ("id"));
+CREATE UNIQUE INDEX "tweet_tw_id" ON "tweet" ("tw_id");
+CREATE INDEX "tweet_twitter_user_id" ON "tweet" ("twitter_user_id");
+CREATE TABLE "subscription" ("id" INTEGER NOT NULL PRIMARY KEY, "tg_chat_id" INTEGER NOT NULL,
+    "tw_user_id" INTEGER NOT NULL, "known_at" DATETIME NOT NULL, "last_tweet_id" INTEGER NOT NULL,
+    "sub_kind" INTEGER NOT NULL, FOREIGN KEY ("tg_chat_id") REFERENCES "telegramchat" ("id"),
+    FOREIGN KEY ("tw_user_id") REFERENCES "twitteruser" ("id"));
+CREATE INDEX "subscription_tg_chat_id" ON "subscription" ("tg_chat_id");
+CREATE INDEX "subscription_tw_user_id" ON "subscription" ("tw_user_id");
+INSERT INTO twitteruser VALUES (1, 'alice', '2021-01-01', 'Alice', '2021-01-01');
+INSERT INTO telegramchat VALUES (1, 10, '2021-01-01', 'private', '2021-01-01',
+    NULL, NULL, NULL, NULL, 0);
+INSERT INTO tweet VALUES (1, 100, '2021-01-01', 'hi', '2021-01-01', 1,
+    "['https://a/1.jpg', 'https://a/2.jpg']", '');
+INSERT INTO tweet VALUES (2, 101, '2021-01-01', 'hey', '2021-01-01', 1, '[]', 'https://a/v.mp4');
+INSERT INTO subscription VALUES (1, 1, 1, '2021-01-01', 100, 0);
+INSERT INTO subscription VALUES (2, 1, 1, '2021-01-01', 100, 0);
+'''
+
+
+@pytest.fixture
+def database(tmp_path):
+    yield str(tmp_path / 'test.db')
+    db.close()
+
+
+def plan(query):
+    sql, params = query.sql()
+    return ' / '.join(row[-1] for row in db.execute_sql('EXPLAIN QUERY PLAN ' + sql, params))
+
+
+def test_new_database_is_current(database):
+    init_db(database)
+    migrations.migrate_schema()
+    assert migrations.schema_version() == len(migrations.MIGRATIONS)
+    for model in migrations.MODELS:
+        assert model.table_exists()
+
+
+def test_baseline_database_migrates(database):
+    conn = sqlite3.connect(database)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.close()
+
+    init_db(database)
+    migrations.migrate_schema()
+
+    assert migrations.schema_version() == len(migrations.MIGRATIONS)
+    assert db.execute_sql('PRAGMA integrity_check').fetchone()[0] == 'ok'
+    for model in migrations.MODELS:
+        assert model.table_exists()
+    assert TwitterUser.get(TwitterUser.screen_name == 'alice').last_tweet_id == 101
+    assert Subscription.select().count() == 1
+    media = TweetMedia.by_tweet([100, 101])
+    assert [m.url for m in media[100]] == ['https://a/1.jpg', 'https://a/2.jpg']
+    assert [(m.kind, m.url) for m in media[101]] == [('video', 'https://a/v.mp4')]
+
+    # and running it again changes nothing
+    migrations.migrate_schema()
+    assert migrations.schema_version() == len(migrations.MIGRATIONS)
+
+
+def test_queries_use_indexes(database):
+    init_db(database)
+    migrations.migrate_schema()
+
+    fanout = plan(pending_deliveries([1, 2], datetime.now()))
+    assert 'USING INDEX subscription_tw_user_id' in fanout
+    assert 'INDEX tweet_twitter_user_id_tw_id' in fanout
+
+    for query in (due_query(), due_query(unlisted_only=True, shards=[0, 1])):
+        assert 'SCAN t1 USING INDEX twitteruser_next_poll_at' in plan(query)
+        assert 'TEMP B-TREE' not in plan(query)
+
+    cleanup = plan(TelegramChat.select().where(TelegramChat.delete_soon == True))
+    assert 'USING INDEX telegramchat_delete_soon' in cleanup
+
+    assert 'USING COVERING INDEX tweet_twitter_user_id_tw_id' in plan(
+        Tweet.select(Tweet.tw_id).where(Tweet.twitter_user == 1, Tweet.tw_id > 100))
@@ -0,0 +1,143 @@
+import datetime
+import logging
+
+import tweepy
+
+from models import TwitterList, TwitterUser, Subscription
+
+LIST_MAX_MEMBERS = 5000
+LIST_CHUNK = 100  # lists/members/create_all and destroy_all take up to 100 users
+LIST_NAME = "forwarder-{}"
+LIST_PAGE_COUNT = 200
+LIST_MAX_PAGES = 4
+
+logger = logging.getLogger(__name__)
+
+
+def chunks(seq, size):
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def sync_lists(tw):
+    """Make the bot-owned lists match the current subscriptions"""
+    subscribed = Subscription.select(Subscription.tw_user)
+
+    # drop the accounts nobody is subscribed to anymore
+    orphans = (TwitterUser.select(TwitterUser.id, TwitterUser.screen_name, TwitterUser.twitter_list)
+               .where(TwitterUser.twitter_list.is_null(False),
+                      TwitterUser.id.not_in(subscribed))
+               .tuples())
+    by_list = {}
+    for user_id, screen_name, list_pk in orphans.iterator():
+        by_list.setdefault(list_pk, []).append((user_id, screen_name))
+    for list_pk, tw_users in by_list.items():
+        tw_list = TwitterList.get_by_id(list_pk)
+        for chunk in chunks(tw_users, LIST_CHUNK):
+            try:
+                tw.remove_list_members(list_id=tw_list.list_id,
+                                       screen_name=[screen_name for _, screen_name in chunk])
+            except tweepy.errors.TweepyException as e:
+                logger.warning("Couldn't remove members from list {}: {}".format(
+                    tw_list.name, e))
+                continue
+            TwitterUser.update(twitter_list=None) \
+                .where(TwitterUser.id << [user_id for user_id, _ in chunk]).execute()
+            tw_list.member_count = max(0, tw_list.member_count - len(chunk))
+        tw_list.save()
+
+    # put the new subscriptions into lists with room left
+    pending = list(TwitterUser.select(TwitterUser.id, TwitterUser.screen_name)
+                   .where(TwitterUser.twitter_list.is_null(True),
+                          TwitterUser.id << subscribed)
+                   .order_by(TwitterUser.id)
+                   .tuples())
+    if not pending:
+        return
+
+    lists = list(TwitterList.select()
+                 .where(TwitterList.member_count < LIST_MAX_MEMBERS)
+                 .order_by(TwitterList.id))
+    while pending:
+        if not lists:
+            try:
+                created = tw.create_list(
+                    name=LIST_NAME.format(TwitterList.select().count() + 1),
+                    mode='private')
+            except tweepy.errors.TweepyException as e:
+                logger.warning("Couldn't create a new list: {}".format(e))
+                return
+            lists.append(TwitterList.create(list_id=created.id, name=created.name))
+
+        tw_list = lists[0]
+        room = LIST_MAX_MEMBERS - tw_list.member_count
+        batch, pending = pending[:room], pending[room:]
+        for chunk in chunks(batch, LIST_CHUNK):
+            try:
+                result = tw.add_list_members(list_id=tw_list.list_id,
+                                             screen_name=[screen_name for _, screen_name in chunk])
+            except tweepy.errors.TweepyException as e:
+                logger.warning("Couldn't add members to list {}: {}".format(
+                    tw_list.name, e))
+                continue
+            TwitterUser.update(twitter_list=tw_list) \
+                .where(TwitterUser.id << [user_id for user_id, _ in chunk]).execute()
+            tw_list.member_count = result.member_count
+        tw_list.save()
+        if tw_list.member_count >= LIST_MAX_MEMBERS or pending:
+            lists.pop(0)
+
+
+def fetch_list_tweets(tw, tw_list):
+    """Fetch the new tweets of a list, grouped by the member who posted them"""
+    # members catching up with user_timeline would skip that gap if a list
+    # poll stored their newer tweets first
+    members = list(TwitterUser.select(TwitterUser.id, TwitterUser.tw_id, TwitterUser.screen_name)
+                   .where(TwitterUser.twitter_list == tw_list, TwitterUser.list_gap == False))
+    by_id = {u.tw_id: u for u in members if u.tw_id is not None}
+    by_name = {u.screen_name.lower(): u for u in members}
+
+    tweets = []
+    max_id = None
+    complete = False
+    for _ in range(LIST_MAX_PAGES):
+        page = tw.list_timeline(
+            list_id=tw_list.list_id,
+            since_id=tw_list.last_tweet_id or None,
+            max_id=max_id,
+            count=LIST_PAGE_COUNT,
+            include_rts=True,
+            tweet_mode='extended')
+        tweets.extend(page)
+        # without a since_id the first page is enough to get started
+        if len(page) < LIST_PAGE_COUNT or not tw_list.last_tweet_id:
+            complete = True
+            break
+        max_id = page[-1].id - 1
+
+    if not complete:
+        # more new tweets than the pages read: storing these would move the
+        # members past the ones in between. Their own user_timeline polls get
+        # those, the list goes on from its newest tweet
+        logger.info("List {} had more new tweets than {} pages, "
+                    "its members catch up one by one".format(tw_list.name, LIST_MAX_PAGES))
+        TwitterUser.update(list_gap=True, next_poll_at=datetime.datetime.now()) \
+            .where(TwitterUser.id << [u.id for u in members]).execute()
+        tw_list.last_tweet_id = max(tw_list.last_tweet_id, max(t.id for t in tweets))
+        members = []
+        tweets = []
+
+    grouped = {u: [] for u in members}
+    for tweet in tweets:
+        tw_user = by_id.get(tweet.user.id) or by_name.get(tweet.user.screen_name.lower())
+        if tw_user is None:
+            continue
+        grouped[tw_user].append(tweet)
+
+    if tweets:
+        tw_list.last_tweet_id = max(tw_list.last_tweet_id, max(t.id for t in tweets))
+    tw_list.polled_at = datetime.datetime.now()
+    tw_list.save()
+
+    return grouped
+
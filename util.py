@@ -1,5 +1,11 @@
-from functools import wraps
+from collections import OrderedDict
+from functools import wraps, lru_cache
+from threading import Lock
 import re
+import time
+
+import tweepy
+from pytz import timezone
 
 
 def with_touched_chat(f):
@@ -44,3 +50,81 @@ def prepare_tweet_text(text):
     res = markdown_twitter_usernames(res)
     res = markdown_twitter_hashtags(res)
     return res
+
+
+def lookup_users(api, **kwargs):
+    """users/lookup, with no users rather than an error when none of them exist"""
+    try:
+        return api.lookup_users(**kwargs)
+    except tweepy.errors.NotFound:
+        return []
+
+
+@lru_cache(maxsize=None)
+def get_timezone(name):
+    """pytz.timezone() with the lookups cached, there are only a few hundred zones"""
+    return timezone(name)
+
+
+class LRUCache(object):
+    """
+    Thread-safe mapping that keeps the `maxsize` most recently used entries,
+    for `ttl` seconds at most
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                return default
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            value = self._data.pop(key, None)
+        return default if value is None else value[0]
+
+
+class Counters(object):
+    """Thread-safe named counters, for numbers worth watching over the bot's lifetime"""
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = Lock()
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + amount
+
+    def get(self, name):
+        with self._lock:
+            return self._counts.get(name, 0)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+metrics = Counters()